@@ -0,0 +1,51 @@
+"""Compare per-point Python loops with vectorized masks for ground/surface point selection"""
+
+import parasol
+import logging
+import time
+import numpy as np
+
+logging.basicConfig(level=logging.WARNING)
+
+# one full surface tile, including pad
+x_min = 328000 - parasol.surface.PAD
+x_max = 329000 + parasol.surface.PAD
+y_min = 4690000 - parasol.surface.PAD
+y_max = 4691000 + parasol.surface.PAD
+classes = set(parasol.cfg.SURFACE_CLASSES)
+
+# unfiltered points, as the original grid_points retrieved them
+t0 = time.time()
+pts = parasol.lidar.retrieve(x_min, x_max, y_min, y_max)
+print(f'retrieve all: {len(pts)} points, {time.time() - t0:.2f} s')
+
+# original: two per-point loops
+t0 = time.time()
+grnd_idx = []
+for idx, pt in enumerate(pts):
+    if pt['ReturnNumber'] == pt['NumberOfReturns'] and pt['Classification'] in classes:
+        grnd_idx.append(idx)
+surf_idx = []
+for idx, pt in enumerate(pts):
+    if (pt['ReturnNumber'] == 1 or pt['NumberOfReturns'] == 1) and pt['Classification'] in classes:
+        surf_idx.append(idx)
+t_loop = time.time() - t0
+print(f'python loops: {t_loop:.2f} s')
+
+# vectorized: boolean masks over the whole array
+t0 = time.time()
+grnd_mask = parasol.lidar.select(pts, classes, 'last')
+surf_mask = parasol.lidar.select(pts, classes, 'first')
+t_mask = time.time() - t0
+print(f'boolean masks: {t_mask:.4f} s, speedup {t_loop/t_mask:.0f}x')
+assert np.array_equal(np.flatnonzero(grnd_mask), grnd_idx)
+# note: masks select first returns by ReturnNumber only, as the database filters do,
+#   the loop also accepted NumberOfReturns == 1, which differs only for malformed points
+print(f'surface selection differs for {len(np.setxor1d(np.flatnonzero(surf_mask), surf_idx))} points')
+
+# pushed down: filtered in the database
+t0 = time.time()
+sets = parasol.lidar.retrieve_sets(x_min, x_max, y_min, y_max, {
+    'ground': (classes, 'last'), 'surface': (classes, 'first')})
+print(f'retrieve filtered: {len(sets["ground"])} ground, {len(sets["surface"])} surface points, '
+      f'{time.time() - t0:.2f} s')
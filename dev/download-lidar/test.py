@@ -0,0 +1,73 @@
+"""Exercise concurrent, resumable LiDAR downloads against a local HTTP stand-in"""
+
+import parasol
+import logging
+import os
+import hashlib
+import threading
+import tempfile
+import http.server
+import socketserver
+
+logging.basicConfig(level=logging.INFO)
+
+
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file server with minimal support for 'Range: bytes=N-' requests"""
+
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def translate_path(self, path):
+        # note: the directory argument needs Python 3.7, serve from src_dir instead
+        return os.path.join(src_dir, os.path.basename(path.split('?')[0]))
+
+    def do_GET(self):
+        rng = self.headers.get('Range')
+        if not rng:
+            return super().do_GET()
+        path = self.translate_path(self.path)
+        start = int(rng.split('=')[1].split('-')[0])
+        with open(path, 'rb') as fp:
+            fp.seek(start)
+            data = fp.read()
+        size = os.path.getsize(path)
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Content-Range', f'bytes {start}-{size-1}/{size}')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Serve each request in its own thread, http.server.ThreadingHTTPServer needs Python 3.7"""
+    daemon_threads = True
+
+
+# create source files and serve them
+src_dir = tempfile.mkdtemp()
+out_dir = tempfile.mkdtemp()
+urls = []
+server = ThreadingHTTPServer(('localhost', 0), RangeHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+for ii in range(8):
+    data = os.urandom(5*2**20)
+    name = f'tile_{ii}.laz'
+    with open(os.path.join(src_dir, name), 'wb') as fp:
+        fp.write(data)
+    urls.append((f'http://localhost:{server.server_port}/{name}', 'md5:' + hashlib.md5(data).hexdigest()))
+
+# simulate a truncated download from an earlier run, and a corrupt partial file
+with open(os.path.join(src_dir, 'tile_0.laz'), 'rb') as fp:
+    with open(os.path.join(out_dir, 'tile_0.laz'), 'wb') as fp_out:
+        fp_out.write(fp.read(2**20))
+with open(os.path.join(out_dir, 'tile_1.laz.part'), 'wb') as fp:
+    fp.write(b'garbage')
+
+failed = parasol.lidar.download_all(urls, out_dir, nconn=4)
+assert not failed
+for url, checksum in urls:
+    filename = os.path.join(out_dir, os.path.basename(url))
+    assert hashlib.md5(open(filename, 'rb').read()).hexdigest() == checksum.split(':')[1]
+assert not [x for x in os.listdir(out_dir) if x.endswith('.part')]
+print('All downloads complete and verified')
+server.shutdown()
@@ -0,0 +1,38 @@
+"""Compare runtime, peak memory, and output of the kNN-median and binned gridding engines"""
+
+import parasol
+import logging
+import time
+import tracemalloc
+import numpy as np
+
+logging.basicConfig(level=logging.WARNING)
+
+# one full surface tile, points retrieved once and shared by both engines
+x_min, x_max = 328000, 329000
+y_min, y_max = 4690000, 4691000
+pad = parasol.surface.PAD
+sets = parasol.lidar.retrieve_sets(x_min-pad, x_max+pad, y_min-pad, y_max+pad, {
+    'ground': (parasol.cfg.SURFACE_CLASSES, 'last'),
+    'surface': (parasol.cfg.SURFACE_CLASSES, 'first')})
+print(f'{len(sets["ground"])} ground, {len(sets["surface"])} surface points')
+
+# grid with each engine, tracking elapsed time and peak (numpy) allocations
+grids = {}
+for engine in parasol.surface.ENGINES:
+    tracemalloc.start()
+    t0 = time.time()
+    _, _, z_grnd, z_surf = parasol.surface.grid_arrays(x_min, x_max, y_min, y_max,
+        sets['ground'], sets['surface'], engine)
+    elapsed = time.time() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    grids[engine] = (z_grnd, z_surf)
+    print(f'{engine}: {elapsed:.2f} s, peak memory {peak/1e6:.0f} MB, '
+          f'{np.sum(np.isnan(z_grnd))} ground and {np.sum(np.isnan(z_surf))} surface cells empty')
+
+# difference from the kNN-median output
+for name, ref, new in zip(['ground', 'surface'], grids['knn'], grids['bin']):
+    diff = np.abs(new - ref)
+    print(f'{name}: bin - knn, mean abs {np.nanmean(diff):.3f} m, '
+          f'p99 abs {np.nanpercentile(diff, 99):.3f} m, max abs {np.nanmax(diff):.3f} m')
@@ -0,0 +1,91 @@
+"""
+Compare the native insolation engine to GRASS r.sun on a small synthetic DSM,
+then time a full day of native frames on the real surface mosaic
+"""
+
+import parasol
+import logging
+import math
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+from osgeo import gdal, osr
+
+logging.basicConfig(level=logging.WARNING)
+
+DAY = 172
+HOURS = [7, 9.5, 12, 14.5, 17]
+RES = 1
+X0, Y0 = 330000, 4692000 # upper left corner, inside the parasol domain
+
+# synthetic DSM: gently sloping ground, a box building, and a conical tree
+rows, cols = 300, 300
+yy, xx = np.mgrid[0:rows, 0:cols]
+grnd = (10 + 0.01*xx).astype(np.float32)
+surf = grnd.copy()
+surf[100:140, 120:180] += 20
+surf += np.clip(12 - 0.8*np.hypot(xx - 80, yy - 220), 0, None).astype(np.float32)
+mask = (surf - grnd) > parasol.shade.MASK_HEIGHT
+transform = (X0, RES, 0, Y0, 0, -RES)
+ref = osr.SpatialReference()
+ref.ImportFromEPSG(parasol.cfg.PRJ_SRID)
+projection = ref.ExportToWkt()
+
+with tempfile.TemporaryDirectory() as tmp:
+    surf_file = os.path.join(tmp, 'surface.tif')
+    parasol.shade._write_geotiff(surf_file, surf, transform, projection)
+
+    # GRASS: throwaway location and mapset
+    mapset = os.path.join(tmp, 'grassdb', 'compare', 'PERMANENT')
+    subprocess.run(['grass74', '-c', f'EPSG:{parasol.cfg.PRJ_SRID}', '-e', os.path.dirname(mapset)], check=True)
+    def grass(*args):
+        subprocess.run(['grass74', mapset, '--exec', *args], check=True, stdout=subprocess.DEVNULL)
+    grass('r.in.gdal', f'input={surf_file}', 'output=surface')
+    grass('g.region', 'raster=surface')
+    grass('r.slope.aspect', 'elevation=surface', 'slope=slope', 'aspect=aspect')
+
+    slope, aspect = parasol.shade.slope_aspect(surf, RES)
+    lat = sum(parasol.cfg.DOMAIN_YLIM_GEO)/2
+    for hour in HOURS:
+        # GRASS
+        t0 = time.time()
+        grass('r.sun', f'time={hour}', f'day={DAY}', 'elevation=surface', 'aspect=aspect',
+            'slope=slope', 'glob_rad=glob', 'beam_rad=beam', '--overwrite')
+        out_file = os.path.join(tmp, 'out.tif')
+        grass('r.out.gdal', 'input=glob', f'output={out_file}', 'format=GTiff', '--overwrite')
+        grass_glob = gdal.Open(out_file).GetRasterBand(1).ReadAsArray()
+        grass('r.out.gdal', 'input=beam', f'output={out_file}', 'format=GTiff', '--overwrite')
+        grass_shadow = gdal.Open(out_file).GetRasterBand(1).ReadAsArray() <= 0
+        t_grass = time.time() - t0
+
+        # native
+        t0 = time.time()
+        elevation, azimuth = parasol.shade.solar_position(DAY, hour, lat)
+        shadow = parasol.shade.cast_shadows(surf, RES, elevation, azimuth)
+        native_glob = parasol.shade.clear_sky(DAY, elevation, azimuth, surf, slope, aspect, shadow)
+        t_native = time.time() - t0
+
+        # compare, ignoring the edges where slope is undefined in GRASS
+        inner = (slice(2, -2), slice(2, -2))
+        diff = np.abs(native_glob - grass_glob)[inner]
+        agree = np.mean(shadow[inner] == grass_shadow[inner])
+        print(f'hour {hour:5.2f}: sun elevation {math.degrees(elevation):5.1f} deg, '
+              f'shadow agreement {100*agree:.1f}%, '
+              f'glob_rad mean abs diff {np.nanmean(diff):.1f} W/m2 (p95 {np.nanpercentile(diff, 95):.1f}), '
+              f'grass {t_grass:.2f} s, native {t_native:.3f} s')
+
+# full day of frames on the real surface, excluding file output
+t0 = time.time()
+parasol.shade._native_init()
+print(f'native: load static inputs {time.time() - t0:.1f} s')
+inp = parasol.shade._native_inputs
+t0 = time.time()
+metas = parasol.common.shade_meta()
+for meta in metas:
+    hour = meta['hour'] + meta['minute']/60
+    elevation, azimuth = parasol.shade.solar_position(DAY, hour, inp['lat'])
+    shadow = parasol.shade.cast_shadows(inp['surface'], parasol.cfg.SURFACE_RES_M, elevation, azimuth)
+    parasol.shade.clear_sky(DAY, elevation, azimuth, inp['surface'], inp['slope'], inp['aspect'], shadow)
+print(f'native: {len(metas)} frames, {inp["surface"].shape} cells, {time.time() - t0:.1f} s')
@@ -0,0 +1,31 @@
+"""Compare in-process patch decoding with the PDAL CSV round-trip for LiDAR retrieval"""
+
+import parasol
+import logging
+import time
+import numpy as np
+
+logging.basicConfig(level=logging.WARNING)
+
+# one full surface tile, including pad
+x_min = 328000 - parasol.surface.PAD
+x_max = 329000 + parasol.surface.PAD
+y_min = 4690000 - parasol.surface.PAD
+y_max = 4691000 + parasol.surface.PAD
+repeats = 3
+
+for name, func in [('pdal', parasol.lidar.retrieve_pdal), ('binary', parasol.lidar.retrieve)]:
+    elapsed = []
+    for ii in range(repeats):
+        t0 = time.time()
+        pts = func(x_min, x_max, y_min, y_max)
+        elapsed.append(time.time() - t0)
+    print(f'{name}: {len(pts)} points, {pts.nbytes/1e6:.1f} MB, best of {repeats}: {min(elapsed):.2f} s')
+
+# confirm both paths return the same points (up to ordering)
+old = parasol.lidar.retrieve_pdal(x_min, x_max, y_min, y_max)
+new = parasol.lidar.retrieve(x_min, x_max, y_min, y_max)
+new = np.column_stack([new[x] for x in parasol.lidar.POINT_DTYPE.names])
+old = old[np.lexsort(old.T[::-1])]
+new = new[np.lexsort(new.T[::-1])]
+print(f'max abs difference: {np.max(np.abs(old - new), axis=0)}')
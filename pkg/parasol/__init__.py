@@ -12,8 +12,10 @@ CONFIG_FILE_DEFAULT = resource_filename('parasol', 'config.json.default')
 if not os.path.isfile(CONFIG_FILE):
     print(f'Config file not found -- creating default file at: {CONFIG_FILE}')
     copyfile(CONFIG_FILE_DEFAULT, CONFIG_FILE)
-with open(CONFIG_FILE, 'r') as fp:
+with open(CONFIG_FILE_DEFAULT, 'r') as fp:
     config = json.load(fp)
+with open(CONFIG_FILE, 'r') as fp:
+    config.update(json.load(fp)) # note: keys added since the config file was created keep their defaults
 
 # compute domain limits in geographic coords
 prj0 = pyproj.Proj(init=f'epsg:{config["PRJ_SRID"]}')
@@ -83,6 +83,51 @@ def tile_limits(x_min, x_max, y_min, y_max, x_tile, y_tile):
 
     return tiles
 
+def tile_limits_balanced(x_min, x_max, y_min, y_max, x_tile, y_tile, x_pts, y_pts,
+        n_pts, max_points, min_dim, res=1):
+    """
+    Return list of bounding boxes for tiles with a bounded number of points
+    
+    Starts from the uniform tiles from tile_limits(), then splits each tile
+    into quadrants (recursively) until it contains at most max_points, or
+    cannot be split further
+    
+    Arguments:
+        x_min, x_max, y_min, y_max: floats, limits for the full region-of-interest
+        x_tile, y_tile: floats, maximum dimensions for generated tiles, see
+            tile_limits()
+        x_pts, y_pts, n_pts: numpy 1D arrays, locations and point counts
+            summarizing the point density, e.g., one entry per LiDAR patch
+        max_points: int, desired maximum number of points per tile
+        min_dim: float, tiles smaller than this are not split further
+        res: float, split positions are aligned to multiples of this
+            distance from the tile edges, so that grids are continuous 
+
+    Returns: list of bounding boxes, each a dict with fields x_min, x_max,
+        y_min, y_max, and num_points
+    """
+    tiles = []
+    stack = tile_limits(x_min, x_max, y_min, y_max, x_tile, y_tile)
+    while stack:
+        tile = stack.pop()
+        inside = ((x_pts >= tile['x_min']) & (x_pts < tile['x_max']) &
+                  (y_pts >= tile['y_min']) & (y_pts < tile['y_max']))
+        num_points = int(np.sum(n_pts[inside]))
+        x_dim = tile['x_max'] - tile['x_min']
+        y_dim = tile['y_max'] - tile['y_min']
+        if num_points <= max_points or max(x_dim, y_dim) / 2 < min_dim:
+            tile['num_points'] = num_points
+            tiles.append(tile)
+            continue
+        x_mid = tile['x_min'] + res*math.floor(x_dim/res/2)
+        y_mid = tile['y_min'] + res*math.floor(y_dim/res/2)
+        for x0, x1 in [(tile['x_min'], x_mid), (x_mid, tile['x_max'])]:
+            for y0, y1 in [(tile['y_min'], y_mid), (y_mid, tile['y_max'])]:
+                stack.append({'x_min': x0, 'x_max': x1, 'y_min': y0, 'y_max': y1})
+
+    return tiles
+
+
 def shade_meta():
     """
     Return shade layer details, computed from config constants
@@ -9,7 +9,7 @@ from pkg_resources import resource_filename
 import os
 import glob
 
-from parasol import cfg
+from parasol import cfg, shade
 
 
 logger = logging.getLogger(__name__)
@@ -131,14 +131,29 @@ def add_geoserver_layer(tif_file):
     return resp
 
 
+def add_geoserver_layers():
+    """
+    Upload layer definitions for all published shade frames, see shade.publish_day()
+
+    Layers point to the stable current directory, not to a stored day, so they
+    remain valid when the shade store is updated.
+    """
+    if not shade.published_frames():
+        logger.warning('No shade published, no layers added')
+        return
+    for fn in glob.glob(os.path.join(shade.current_dir(), 'bot_*.tif')):
+        add_geoserver_layer(fn)
+    for fn in glob.glob(os.path.join(shade.current_dir(), 'top_*.tif')):
+        add_geoserver_layer(fn)
+
+
 def init_geoserver():
     """Initialize geoserver workspace, layers, and style"""
     add_geoserver_workspace()
     add_geoserver_style()
-    for fn in glob.glob(os.path.join(cfg.SHADE_DIR, 'bot_*.tif')):
-        add_geoserver_layer(fn)
-    for fn in glob.glob(os.path.join(cfg.SHADE_DIR, 'top_*.tif')):
-        add_geoserver_layer(fn)
+    if not shade.published_frames():
+        shade.publish_day()
+    add_geoserver_layers()
 
 
 def initialize_geoserver_cli():
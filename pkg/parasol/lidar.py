@@ -15,20 +15,56 @@ import os
 import json
 import subprocess
 from pkg_resources import resource_filename
-import wget
+import requests
+import zlib
+import hashlib
+import concurrent.futures
+import tempfile
+import math
+from osgeo import osr
+from xml.etree import ElementTree
 
 from parasol import cfg, common
 
 
 logger = logging.getLogger(__name__)
-    
 
-def create_db(clobber=False):
+
+# local constants
+MANIFEST_TABLE = f'{cfg.LIDAR_TABLE}_manifest'
+DOWNLOAD_ATTEMPTS = 5
+DOWNLOAD_TIMEOUT = 60 # seconds, applies to connect and to each read
+PATCH_FETCH_SIZE = 1000 # patches per round-trip for server-side cursors
+MORTON_BITS = 16 # per axis, for patch clustering keys
+LAZ_CHUNK_SIZE = 1000000 # points per chunk when reading LAZ files directly
+Z_OFFSET = -100 # meters, below the lowest elevation, so stored Z values are
+                #   positive and sigbits compression is not defeated by sign bits
+POINT_DTYPE = np.dtype([
+    ('X', 'f8'), ('Y', 'f8'), ('Z', 'f4'),
+    ('ReturnNumber', 'u1'), ('NumberOfReturns', 'u1'), ('Classification', 'u1')])
+_PC_NS = {'pc': 'http://pointcloud.org/schemas/PC/1.1'}
+_PC_TYPES = {
+    'int8_t': 'i1', 'uint8_t': 'u1', 'int16_t': 'i2', 'uint16_t': 'u2',
+    'int32_t': 'i4', 'uint32_t': 'u4', 'int64_t': 'i8', 'uint64_t': 'u8',
+    'float': 'f4', 'double': 'f8'}
+_PC_NONE, _PC_DIMENSIONAL = 0, 1 # patch compression types
+_PC_DIM_NONE, _PC_DIM_RLE, _PC_DIM_SIGBITS, _PC_DIM_ZLIB = 0, 1, 2, 3 # dimension compression types
+_SCHEMAS = {} # cache of parsed schemas, keyed by pcid
+
+
+def create_db(clobber=False, partition_level=0):
     """
     Create a new database and initialize for lidar point data
 
+    Patches are keyed by a Morton (Z-order) code of their centroid, see
+    _create_morton_function(), so that patches which are close in space can be
+    stored close together on disk, see recluster().
+
     Arguments:
         clobber: set True to delete and re-initialize an existing database
+        partition_level: int, set > 0 to partition the patch table into a
+            2^level x 2^level grid of domain tiles, set 0 to disable partitioning,
+            each partition has its own primary key, Morton and GiST indexes
 
     Return: Nothing
     """
@@ -37,79 +73,1077 @@ def create_db(clobber=False):
         cur.execute('CREATE EXTENSION postgis;')
         cur.execute('CREATE EXTENSION pointcloud;')
         cur.execute('CREATE EXTENSION pointcloud_postgis;')
-        cur.execute(f'CREATE TABLE {cfg.LIDAR_TABLE} (id SERIAL PRIMARY KEY, pa PCPATCH(1));')
-        cur.execute(f'CREATE INDEX ON {cfg.LIDAR_TABLE} USING GIST(PC_EnvelopeGeometry(pa));')
+        _create_morton_function(cur)
+        if partition_level:
+            # each partition covers a block of morton keys, which is a square domain tile
+            # note: PostgreSQL 10 does not allow keys or indexes on the partitioned
+            #   table itself, so each partition gets its own
+            cur.execute(f'CREATE TABLE {cfg.LIDAR_TABLE} (id SERIAL, morton BIGINT NOT NULL, '
+                'pa PCPATCH(1)) PARTITION BY RANGE (morton);')
+            span = 4**(MORTON_BITS - partition_level)
+            for ii in range(4**partition_level):
+                part = f'{cfg.LIDAR_TABLE}_p{ii:04d}'
+                cur.execute(f'CREATE TABLE {part} PARTITION OF {cfg.LIDAR_TABLE} '
+                    f'(PRIMARY KEY (id)) FOR VALUES FROM ({ii*span}) TO ({(ii + 1)*span});')
+                cur.execute(f'CREATE INDEX {part}_morton_idx ON {part} (morton);')
+                cur.execute(f'CREATE INDEX ON {part} USING GIST(PC_EnvelopeGeometry(pa));')
+        else:
+            cur.execute(f'CREATE TABLE {cfg.LIDAR_TABLE} (id SERIAL PRIMARY KEY, '
+                'morton BIGINT NOT NULL, pa PCPATCH(1));')
+            cur.execute(f'CREATE INDEX {cfg.LIDAR_TABLE}_morton_idx ON {cfg.LIDAR_TABLE} (morton);')
+            cur.execute(f'CREATE INDEX ON {cfg.LIDAR_TABLE} USING GIST(PC_EnvelopeGeometry(pa));')
+        _create_manifest(cur)
     logger.info(f'Created new database: {cfg.LIDAR_DB} @ {cfg.PSQL_HOST}:{cfg.PSQL_PORT}')
 
 
-def ingest(laz_file):
+def _create_morton_function(cur):
+    """
+    Create SQL function morton_key(x, y) returning the Morton code for a point
+
+    Coordinates are quantized to MORTON_BITS bits on a square grid covering
+    the domain plus a margin of half the domain size on all sides, points
+    outside are clamped to the edges. Bits are interleaved as x0, y0, x1, y1, ...
+
+    Arguments:
+        cur: psycopg2 cursor connected to the LiDAR database
+
+    Returns: Nothing
+    """
+    size = max(cfg.DOMAIN_XLIM[1] - cfg.DOMAIN_XLIM[0], cfg.DOMAIN_YLIM[1] - cfg.DOMAIN_YLIM[0])
+    x0 = cfg.DOMAIN_XLIM[0] - size/2
+    y0 = cfg.DOMAIN_YLIM[0] - size/2
+    cell = 2*size/2**MORTON_BITS
+    nmax = 2**MORTON_BITS - 1
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION morton_key(x float8, y float8) RETURNS bigint AS $$
+            SELECT COALESCE(SUM((((xi >> b) & 1) << (2*b)) | (((yi >> b) & 1) << (2*b + 1))), 0)::bigint
+            FROM (SELECT GREATEST(LEAST(floor((x - {x0})/{cell}), {nmax}), 0)::bigint AS xi,
+                         GREATEST(LEAST(floor((y - {y0})/{cell}), {nmax}), 0)::bigint AS yi) AS q,
+                 generate_series(0, {MORTON_BITS - 1}) AS b
+        $$ LANGUAGE sql IMMUTABLE;""")
+
+
+def recluster():
+    """
+    Physically reorder patches by Morton key and refresh planner statistics
+
+    Ingest writes each file in Morton order, but files are appended one after
+    another, run this after ingest so bbox queries read mostly contiguous
+    pages. Takes an exclusive lock on the table while running.
+
+    Arguments: None
+    
+    Returns: Nothing
+    """
+    with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
+        cur.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass ORDER BY c.relname;', (cfg.LIDAR_TABLE,))
+        tables = [rec[0] for rec in cur.fetchall()] or [cfg.LIDAR_TABLE]
+        for table in tables:
+            logger.info(f'Clustering table {table}')
+            cur.execute(f'CLUSTER {table} USING {table}_morton_idx;')
+            cur.execute(f'ANALYZE {table};')
+
+
+def _create_manifest(cur):
+    """
+    Create the ingest manifest table, if it does not exist already
+
+    The manifest has one row per source file, recording the file size, hash,
+    thinning voxel size, range of patch ids it occupies in the LiDAR table,
+    and the ingest status, one of 'loading', 'done', or 'failed'
+
+    Arguments:
+        cur: psycopg2 cursor connected to the LiDAR database
+
+    Returns: Nothing
+    """
+    cur.execute(f'CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} ('
+        'file_name TEXT PRIMARY KEY, file_size BIGINT, file_hash TEXT, voxel REAL, '
+        'min_id INTEGER, max_id INTEGER, status TEXT);')
+
+
+def _file_hash(filename, algorithm='sha1'):
+    """Return hex digest of file contents, using the named hashlib algorithm"""
+    sha = hashlib.new(algorithm)
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(2**20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _http_session(nconn):
+    """Return HTTP session with a pool of keep-alive connections"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=nconn, pool_maxsize=nconn)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _verify(filename, size, checksum):
+    """
+    Check downloaded file against expected size and checksum
+
+    Arguments:
+        filename: string, path to downloaded file
+        size: int, expected file size in bytes, or None to skip check
+        checksum: string, expected checksum as 'algorithm:hexdigest', or None
+            to skip check
+
+    Returns: True if all checks pass, else False
+    """
+    if size is not None and os.path.getsize(filename) != size:
+        return False
+    if checksum is not None:
+        algorithm, digest = checksum.split(':')
+        if _file_hash(filename, algorithm) != digest.lower():
+            return False
+    return True
+
+
+def _content_size(resp):
+    """
+    Return the full size of a remote file from HTTP response headers
+
+    Arguments:
+        resp: requests.Response, for a HEAD, GET, or ranged GET request
+
+    Returns: int, size in bytes, or None if the server did not provide it
+    """
+    total = resp.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+    if total.isdigit():
+        return int(total)
+    if resp.status_code == 200 and 'Content-Length' in resp.headers:
+        return int(resp.headers['Content-Length'])
+    return None
+
+
+def download(url, out_dir, checksum=None, session=None):
+    """
+    Download file, resuming partial downloads and verifying the result
+
+    Data is written to a '.part' file, which is renamed to the final name only
+    after the size (and checksum, if provided) check passes, so incomplete
+    files are never picked up by ingest. Interrupted transfers are resumed
+    using HTTP Range requests. The expected size comes from a HEAD request,
+    or from the download response if the server rejects HEAD.
+
+    Arguments:
+        url: string, URL to download
+        out_dir: string, path to output directory
+        checksum: string, expected checksum as 'algorithm:hexdigest' (e.g.,
+            'md5:d41d8c...'), or None to skip checksum verification 
+        session: requests.Session to use for (pooled) connections, or None to
+            use a new connection
+
+    Returns: string, path to the downloaded file
+    """
+    filename = os.path.join(out_dir, os.path.basename(url))
+    part_name = filename + '.part'
+    session = session if session else requests.Session()
+    size = None
+
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        # get expected size, if the server provides it
+        if size is None:
+            try:
+                resp = session.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+                resp.raise_for_status()
+                size = _content_size(resp)
+            except requests.exceptions.RequestException as err:
+                logger.warning(f'Size request failed for {url}, using download response: {err}')
+
+        # check existing file, which may have been truncated by an earlier download,
+        #   files that cannot be checked are resumed, which verifies their size
+        if os.path.isfile(filename):
+            if (size is not None or checksum is not None) and _verify(filename, size, checksum):
+                logger.info(f'File {filename} exists, skipping')
+                return filename
+            logger.warning(f'File {filename} is incomplete or corrupt, resuming download')
+            os.rename(filename, part_name)
+
+        offset = os.path.getsize(part_name) if os.path.isfile(part_name) else 0
+        if size is not None and offset > size:
+            offset = 0
+        
+        # fetch remaining bytes
+        if size is None or offset < size:
+            logger.info(f'Downloading URL {url}, starting at byte {offset}')
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+                    if resp.status_code == 416:
+                        size = _content_size(resp) # nothing left to fetch, verified below
+                    else:
+                        resp.raise_for_status()
+                        size = size if size is not None else _content_size(resp)
+                        if resp.status_code != 206:
+                            offset = 0 # server ignored range request, start over
+                        with open(part_name, 'ab' if offset else 'wb') as fp:
+                            for chunk in resp.iter_content(chunk_size=2**20):
+                                fp.write(chunk)
+            except requests.exceptions.RequestException as err:
+                logger.warning(f'Download interrupted for {url}: {err}')
+                continue
+        
+        # release file only if complete and correct
+        if _verify(part_name, size, checksum):
+            os.rename(part_name, filename)
+            logger.info(f'Completed download: {filename}')
+            return filename
+        logger.warning(f'Verification failed for {url}, restarting download')
+        os.remove(part_name)
+
+    raise RuntimeError(f'Failed to download {url} after {DOWNLOAD_ATTEMPTS} attempts')
+
+
+def download_all(urls, out_dir, nconn=4):
+    """
+    Download many files concurrently over a shared connection pool
+
+    Arguments:
+        urls: list of (url, checksum) tuples, checksum may be None, see download()
+        out_dir: string, path to output directory
+        nconn: int, number of concurrent downloads
+
+    Returns: list of urls that failed to download
+    """
+    failed = []
+    session = _http_session(nconn)
+    with concurrent.futures.ThreadPoolExecutor(nconn) as pool:
+        futures = {pool.submit(download, url, out_dir, checksum, session): url
+            for url, checksum in urls}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                logger.error(f'Failed download: {futures[future]}: {err}')
+                failed.append(futures[future])
+    return failed
+
+
+def ingest(laz_file, voxel=None):
     """
     Import points from LAZ file to LiDAR database
 
-    Uses PDAL to split the input into patches and upload patches to the
-    database server. Points from NOAA are pre-classified, so additional
-    pre-processing is not needed.
+    Uses PDAL to split the input into patches and upload patches to a staging
+    table, then moves the patches to the LiDAR table in a single transaction
+    that also marks the file as done in the manifest. Points from NOAA are
+    pre-classified, so additional pre-processing is not needed.
 
-    Beware: no check to avoid duplication, it is up to the user to take care to
-        upload data only once
+    Files already loaded with the same size, hash, and voxel size are skipped.
+    Files that were partially loaded (interrupted) or have changed since
+    loading are cleared and loaded again.
     
     Arguments:
         laz_file: string, path to source file in LAZ format
+        voxel: float, set to thin points before upload, see thin(), set None
+            to keep all points
     
     Returns: Nothing
     """
+    file_name = os.path.basename(laz_file)
+    file_size = os.path.getsize(laz_file)
+    file_hash = _file_hash(laz_file)
+    voxel = voxel if voxel else None
+    stage_table = f'{cfg.LIDAR_TABLE}_stage_{file_hash[:12]}'
+
+    # check manifest, clear any previous (partial or stale) load
+    with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
+        _create_manifest(cur)
+        cur.execute(f'SELECT file_size, file_hash, min_id, max_id, status, voxel FROM {MANIFEST_TABLE} '
+            'WHERE file_name = %s', (file_name,))
+        rec = cur.fetchone()
+        if (rec and rec[0] == file_size and rec[1] == file_hash and rec[4] == 'done'
+                and rec[5] == voxel):
+            logger.info(f'File {laz_file} already ingested, skipping')
+            return
+        if rec and rec[2] is not None:
+            logger.info(f'Clearing previous ingest: {laz_file}')
+            cur.execute(f'DELETE FROM {cfg.LIDAR_TABLE} WHERE id BETWEEN %s AND %s', (rec[2], rec[3]))
+        cur.execute(f'DROP TABLE IF EXISTS {stage_table};')
+        cur.execute(f'DELETE FROM {MANIFEST_TABLE} WHERE file_name = %s', (file_name,))
+        cur.execute(f'INSERT INTO {MANIFEST_TABLE} (file_name, file_size, file_hash, voxel, status) '
+            "VALUES (%s, %s, %s, %s, 'loading')", (file_name, file_size, file_hash, voxel))
+
+    # upload patches to staging table
     logger.info(f'Started ingest: {laz_file}')
-    pipeline_json = json.dumps({
-        "pipeline": [
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if voxel:
+            # thinned points are already reprojected
+            thin_file = os.path.join(tmp_dir, 'thin.las')
+            _write_las(thin_file, thin_laz(laz_file, voxel))
+            stages = [
+                {
+                    "type": "readers.las",
+                    "filename": thin_file,
+                    "spatialreference": f"EPSG:{cfg.PRJ_SRID}",
+                }]
+        else:
+            stages = [
+                {
+                    "type": "readers.las",
+                    "filename": laz_file,
+                }, {
+                    "type": "filters.reprojection",
+                    "out_srs": f"EPSG:{cfg.PRJ_SRID}",
+                }]
+        stages.extend([
             {
-                "type": "readers.las",
-                "filename": laz_file,
-            }, {
-                "type": "filters.reprojection",
-                "out_srs": f"EPSG:{cfg.PRJ_SRID}",
-            }, {
                 "type": "filters.chipper",
                 "capacity": cfg.LIDAR_CHIP,
             }, {
                 "type": "writers.pgpointcloud",
                 "connection": f"host={cfg.PSQL_HOST} dbname={cfg.LIDAR_DB} user={cfg.PSQL_USER} password={cfg.PSQL_PASS} port={cfg.PSQL_PORT}",
-                "table": cfg.LIDAR_TABLE,
+                "table": stage_table,
                 "compression": "dimensional",
                 "srid": cfg.PRJ_SRID,
                 "output_dims": "X,Y,Z,ReturnNumber,NumberOfReturns,Classification", # reduce data volume
                 "scale_x": 0.01, # precision in meters
                 "scale_y": 0.01,
                 "scale_z": 0.01, 
-                "offset_x": 0, # TODO: select a smarter value
+                "offset_x": 0, # coords are positive, offset does not change packing
                 "offset_y": 0,
-                "offset_z": 0,
-            }
-        ]
-    })
-    subprocess.run(['pdal', 'pipeline', '--stdin'], input=pipeline_json.encode('utf-8'))
-    logger.info(f'Completed ingest: {laz_file}')
+                "offset_z": Z_OFFSET,
+            }])
+        pipeline_json = json.dumps({"pipeline": stages})
+        result = subprocess.run(['pdal', 'pipeline', '--stdin'], input=pipeline_json.encode('utf-8'))
+    if result.returncode != 0:
+        with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
+            cur.execute(f"UPDATE {MANIFEST_TABLE} SET status = 'failed' WHERE file_name = %s", (file_name,))
+        raise RuntimeError(f'PDAL pipeline failed for {laz_file}')
+
+    # move patches to lidar table and mark as done, all-or-nothing
+    # note: table lock keeps the patch ids for each file contiguous
+    with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
+        cur.execute(f'LOCK TABLE {cfg.LIDAR_TABLE} IN EXCLUSIVE MODE;')
+        cur.execute(f'WITH ins AS (INSERT INTO {cfg.LIDAR_TABLE} (morton, pa) '
+            'SELECT morton_key(ST_X(c), ST_Y(c)) AS key, pa FROM ('
+            f'SELECT ST_Centroid(PC_EnvelopeGeometry(pa)) AS c, pa FROM {stage_table}) AS stage '
+            'ORDER BY key RETURNING id) SELECT MIN(id), MAX(id) FROM ins;')
+        min_id, max_id = cur.fetchone()
+        cur.execute(f"UPDATE {MANIFEST_TABLE} SET min_id = %s, max_id = %s, status = 'done' "
+            'WHERE file_name = %s', (min_id, max_id, file_name))
+        cur.execute(f'DROP TABLE {stage_table};')
+    logger.info(f'Completed ingest: {laz_file}, patch ids {min_id} - {max_id}')
+
+
+def ingest_all(laz_files, nproc=1, voxel=None):
+    """
+    Import points from many LAZ files using a pool of worker processes
+
+    Arguments:
+        laz_files: list of strings, paths to source files in LAZ format
+        nproc: int, number of concurrent ingest processes
+        voxel: float, set to thin points before upload, see ingest()
+    
+    Returns: list of files that failed to ingest
+    """
+    laz_files = sorted(laz_files)
+    if not laz_files:
+        return []
+    failed = []
+
+    # run the first file alone so that PDAL registers the point schema once,
+    #   concurrent first writes would each register a duplicate pcid
+    try:
+        ingest(laz_files[0], voxel)
+    except Exception as err:
+        logger.error(f'Failed ingest: {laz_files[0]}: {err}')
+        failed.append(laz_files[0])
+
+    with concurrent.futures.ProcessPoolExecutor(nproc) as pool:
+        futures = {pool.submit(ingest, fn, voxel): fn for fn in laz_files[1:]}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                logger.error(f'Failed ingest: {futures[future]}: {err}')
+                failed.append(futures[future])
+    
+    return failed
+
+
+def _schema(cur, pcid):
+    """
+    Return dimension definitions for a pointcloud schema, cached by pcid
+
+    Arguments:
+        cur: psycopg2 cursor connected to the LiDAR database
+        pcid: int, schema ID in the pointcloud_formats table
+
+    Returns: list of dicts, one for each dimension in position order, with fields:
+        name: string, dimension name
+        dtype: numpy dtype, storage type of the dimension (no byte order)
+        scale, offset: floats, conversion from stored to real values
+    """
+    if pcid not in _SCHEMAS:
+        cur.execute('SELECT schema FROM pointcloud_formats WHERE pcid = %s', (pcid,))
+        root = ElementTree.fromstring(cur.fetchone()[0])
+        dims = []
+        for elem in root.findall('pc:dimension', _PC_NS):
+            dims.append({
+                'position': int(elem.find('pc:position', _PC_NS).text),
+                'name': elem.find('pc:name', _PC_NS).text,
+                'dtype': np.dtype(_PC_TYPES[elem.find('pc:interpretation', _PC_NS).text]),
+                'scale': float(getattr(elem.find('pc:scale', _PC_NS), 'text', 1)),
+                'offset': float(getattr(elem.find('pc:offset', _PC_NS), 'text', 0)),
+                })
+        _SCHEMAS[pcid] = sorted(dims, key=lambda x: x['position'])
+    return _SCHEMAS[pcid]
+
+
+def _decode_sigbits(buf, npoints, dtype):
+    """
+    Decode a significant-bits compressed dimension to raw (unscaled) values
+    
+    Arguments:
+        buf: bytes, compressed dimension data
+        npoints: int, number of points in the patch
+        dtype: numpy dtype, storage type with byte order of the dimension
+    
+    Returns: numpy 1D array with the input dtype
+    """
+    word = np.dtype(f'{dtype.byteorder}u{dtype.itemsize}')
+    nbits, common_value = np.frombuffer(buf, dtype=word, count=2)
+    nbits = int(nbits)
+    if nbits == 0:
+        return np.full(npoints, common_value, dtype=word).view(dtype)
+    
+    # unique bits are packed MSB-first in words, unpack and re-pack to full width
+    words = np.frombuffer(buf, dtype=word, offset=2*word.itemsize)
+    bits = np.unpackbits(words.astype(word.newbyteorder('>')).view(np.uint8))
+    bits = bits[:npoints*nbits].reshape((npoints, nbits))
+    full = np.zeros((npoints, 8*word.itemsize), dtype=np.uint8)
+    full[:, -nbits:] = bits
+    values = np.packbits(full, axis=1).view(word.newbyteorder('>')).ravel()
+    return (values | common_value).astype(word).view(dtype)
+
+
+def _decode_dimension(buf, npoints, dtype):
+    """
+    Decode a single dimension from a dimensional-compressed patch
+
+    Arguments:
+        buf: memoryview, patch data starting at the dimension header
+        npoints: int, number of points in the patch
+        dtype: numpy dtype, storage type with byte order of the dimension
+
+    Returns: values, size
+        values: numpy 1D array with the input dtype, raw (unscaled) values
+        size: int, number of bytes consumed from buf, including the header
+    """
+    compression = buf[0]
+    size = int(np.frombuffer(buf, dtype=dtype.byteorder + 'u4', count=1, offset=1)[0])
+    data = buf[5:5+size]
+
+    if compression == _PC_DIM_NONE:
+        values = np.frombuffer(data, dtype=dtype, count=npoints)
+    elif compression == _PC_DIM_RLE:
+        runs = np.frombuffer(data, dtype=[('count', 'u1'), ('value', dtype)])
+        values = np.repeat(runs['value'], runs['count'])
+    elif compression == _PC_DIM_SIGBITS:
+        values = _decode_sigbits(data, npoints, dtype)
+    elif compression == _PC_DIM_ZLIB:
+        values = np.frombuffer(zlib.decompress(data), dtype=dtype, count=npoints)
+    else:
+        raise ValueError(f'Unknown dimensional compression type: {compression}')
+
+    return values, 5 + size
+
+
+def _decode_patch(cur, wkb):
+    """
+    Decode a PCPATCH in well-known-binary format to a structured array
+    
+    Supports patches with no compression or dimensional compression (the
+    format written by ingest()).
+
+    Arguments:
+        cur: psycopg2 cursor connected to the LiDAR database, used to look up
+            the schema for the patch
+        wkb: bytes, patch as well-known-binary
+
+    Returns: numpy 1D array with dtype POINT_DTYPE
+    """
+    buf = memoryview(wkb)
+    order = '<' if buf[0] == 1 else '>'
+    pcid, compression, npoints = np.frombuffer(buf, dtype=order + 'u4', count=3, offset=1)
+    dims = _schema(cur, int(pcid))
+    buf = buf[13:]
+
+    # read raw values for each dimension
+    raw = {}
+    if compression == _PC_NONE:
+        rec_dtype = np.dtype([(x['name'], x['dtype'].newbyteorder(order)) for x in dims])
+        recs = np.frombuffer(buf, dtype=rec_dtype, count=npoints)
+        for dim in dims:
+            raw[dim['name']] = recs[dim['name']]
+    elif compression == _PC_DIMENSIONAL:
+        for dim in dims:
+            raw[dim['name']], size = _decode_dimension(
+                buf, npoints, dim['dtype'].newbyteorder(order))
+            buf = buf[size:]
+    else:
+        raise ValueError(f'Unsupported patch compression type: {compression}')
+    
+    # apply scale and offset, keeping only the dimensions we use
+    pts = np.empty(npoints, dtype=POINT_DTYPE)
+    for dim in dims:
+        if dim['name'] not in POINT_DTYPE.names:
+            continue
+        if dim['scale'] != 1 or dim['offset'] != 0:
+            pts[dim['name']] = raw[dim['name']]*dim['scale'] + dim['offset']
+        else:
+            pts[dim['name']] = raw[dim['name']]
+    return pts
+
+
+def _filter_sql(classes=None, returns=None):
+    """
+    Build SQL that filters patches by classification and return number
+
+    Patch filters cannot compare two dimensions, so last returns are selected
+    by matching ReturnNumber and NumberOfReturns for each possible number of
+    returns in the patch.
+
+    Arguments:
+        classes: iterable of ints, classification codes to keep, or None to keep all
+        returns: string, one of 'first', 'last', or None to keep all
+
+    Returns: joins, expr
+        joins: string, extra FROM items, to follow the source table (aliased 'src')
+        expr: string, expression for the filtered patch
+    """
+    joins = ''
+    expr = 'src.pa'
+    if classes is not None:
+        # contiguous runs of class codes, each selected by a single (exclusive) between filter
+        codes = sorted(set(classes))
+        runs = [[codes[0], codes[0]]] if codes else []
+        for code in codes[1:]:
+            if code == runs[-1][1] + 1:
+                runs[-1][1] = code
+            else:
+                runs.append([code, code])
+        lo = ','.join(str(x[0] - 0.5) for x in runs)
+        hi = ','.join(str(x[1] + 0.5) for x in runs)
+        joins += f', unnest(ARRAY[{lo}]::float8[], ARRAY[{hi}]::float8[]) AS cls(lo, hi)'
+        expr = f"PC_FilterBetween({expr}, 'Classification', cls.lo, cls.hi)"
+    if returns == 'first':
+        expr = f"PC_FilterEquals({expr}, 'ReturnNumber', 1)"
+    elif returns == 'last':
+        joins += ", generate_series(1, PC_PatchMax(src.pa, 'NumberOfReturns')::int) AS nret"
+        expr = f"PC_FilterEquals(PC_FilterEquals({expr}, 'NumberOfReturns', nret), 'ReturnNumber', nret)"
+    elif returns is not None:
+        raise ValueError('Invalid choice for argument "returns"')
+    if expr != 'src.pa':
+        expr = f"PC_Compress({expr}, 'dimensional')" # filters return uncompressed patches
+    return joins, expr
+
+
+def _iter_patches(xmin, xmax, ymin, ymax, filters):
+    """
+    Generate decoded patches for one or more filtered point sets in a single query
+
+    Arguments:
+        minx, maxx, miny, maxy: floats, limits for bounding box 
+        filters: list of (classes, returns) tuples, see _filter_sql()
+
+    Yields: index, pts
+        index: int, position of the filter in the input list
+        pts: numpy 1D structured array with dtype POINT_DTYPE
+    """
+    queries = []
+    for idx, (classes, returns) in enumerate(filters):
+        joins, expr = _filter_sql(classes, returns)
+        queries.append(
+            f'SELECT {idx} AS idx, pa FROM (SELECT {expr} AS pa FROM {cfg.LIDAR_TABLE} AS src{joins} '
+            f'WHERE PC_Intersects(src.pa, ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {cfg.PRJ_SRID}))'
+            ') AS sub WHERE pa IS NOT NULL AND PC_NumPoints(pa) > 0')
+
+    with common.connect_db(cfg.LIDAR_DB) as conn:
+        with conn.cursor() as schema_cur, conn.cursor(name=f'points_{uuid.uuid4().hex}') as cur:
+            cur.itersize = PATCH_FETCH_SIZE
+            cur.execute(' UNION ALL '.join(queries))
+            for rec in cur:
+                yield rec[0], _decode_patch(schema_cur, bytes.fromhex(rec[1]))
+
 
+def iter_points(xmin, xmax, ymin, ymax, chunk_size=None, classes=None, returns=None):
+    """
+    Generate points within a bounding box, patch-by-patch or in fixed-size chunks
+
+    Patches are read from a server-side cursor, so memory use is bounded by
+    the fetch size and chunk size, not by the number of points in the bbox.
+
+    Arguments:
+        minx, maxx, miny, maxy: floats, limits for bounding box 
+        chunk_size: int, number of points in each yielded array (the last
+            may be smaller), set None to yield one array per patch
+        classes: iterable of ints, classification codes to keep, or None to keep all
+        returns: string, one of 'first', 'last', or None to keep all
 
-def retrieve(xmin, xmax, ymin, ymax):
+    Yields: numpy 1D structured arrays with dtype POINT_DTYPE, see retrieve()
+    """
+    buffer = []
+    count = 0
+    for _, pts in _iter_patches(xmin, xmax, ymin, ymax, [(classes, returns)]):
+        if chunk_size is None:
+            yield pts
+            continue
+        buffer.append(pts)
+        count += pts.shape[0]
+        while count >= chunk_size:
+            merged = np.concatenate(buffer)
+            yield merged[:chunk_size]
+            buffer = [merged[chunk_size:]]
+            count = buffer[0].shape[0]
+    if chunk_size is not None and count:
+        yield np.concatenate(buffer)
+
+
+def retrieve(xmin, xmax, ymin, ymax, classes=None, returns=None):
     """
     Retrieve all points within a bounding box
+
+    Selects intersecting patches directly and decodes the binary in-process,
+    which avoids the precision loss of PC_AsText and the cost of the PDAL text
+    round-trip in retrieve_pdal(). See iter_points() to process points in
+    bounded memory instead.
     
     Arguments:
         minx, maxx, miny, maxy: floats, limits for bounding box 
+        classes: iterable of ints, classification codes to keep, or None to keep all
+        returns: string, one of 'first', 'last', or None to keep all, note
+            that single returns are both first and last
 
-    Returns: numpy array with columns
+    Returns: numpy 1D structured array with dtype POINT_DTYPE, fields are
         X, Y, Z, ReturnNumber, NumberOfReturns, Classification
     """
-    # # DISABLED: direct query returns points with reduced precision (AsText) or
-    # #   without non-spatial dimensions (AsBinary). Alternative is to write
-    # #   custom code to parse the binary directly, which is not currently worth
-    # #   the effort
-    # with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
-    #     cur.execute(f'SELECT PC_AsText(PC_Union(pa)) FROM lidar WHERE PC_Intersects('
-    #         f'pa, ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {cfg.PRJ_SRID}))')
-    #     data = np.array(json.loads(cur.fetchone()[0])['pts']) # ordered as ReturnNumber,NumberOfReturns,Classification,X,Y,Z
-    # return np.roll(data, 3) # ordered as X,Y,Z,ReturnNumber,NumberOfReturns,Classification
+    return retrieve_sets(xmin, xmax, ymin, ymax, {'pts': (classes, returns)})['pts']
+
+
+def retrieve_sets(xmin, xmax, ymin, ymax, filters):
+    """
+    Retrieve several filtered sets of points within a bounding box in one query
+
+    Filters are applied in the database, so only the requested points are
+    transferred and decoded.
+
+    Arguments:
+        minx, maxx, miny, maxy: floats, limits for bounding box 
+        filters: dict, keys are set names, values are (classes, returns)
+            tuples, see retrieve()
+
+    Returns: dict, keys are set names, values are numpy 1D structured arrays
+        with dtype POINT_DTYPE
+    """
+    names = list(filters.keys())
+    arrays = {name: [] for name in names}
+    for idx, pts in _iter_patches(xmin, xmax, ymin, ymax, [filters[x] for x in names]):
+        arrays[names[idx]].append(pts)
+    
+    sets = {}
+    for name in names:
+        sets[name] = np.concatenate(arrays[name]) if arrays[name] else np.empty(0, dtype=POINT_DTYPE)
+        logger.info(f'Received {sets[name].shape[0]} points in set "{name}"')
+    return sets
+
+
+def patch_counts(xmin, xmax, ymin, ymax):
+    """
+    Return a cheap summary of point density: patch centroids and point counts
+    
+    Arguments:
+        minx, maxx, miny, maxy: floats, limits for bounding box 
+
+    Returns: x, y, n
+        x, y: numpy 1D arrays, patch centroid coordinates
+        n: numpy 1D array, number of points in each patch
+    """
+    with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
+        cur.execute('SELECT ST_X(c), ST_Y(c), n FROM (SELECT ST_Centroid(PC_EnvelopeGeometry(pa)) AS c, '
+            f'PC_NumPoints(pa) AS n FROM {cfg.LIDAR_TABLE} WHERE PC_Intersects('
+            f'pa, ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {cfg.PRJ_SRID}))) AS sub;')
+        recs = np.array(cur.fetchall(), dtype=float).reshape((-1, 3))
+    return recs[:, 0], recs[:, 1], recs[:, 2].astype(int)
+
+
+def db_version():
+    """
+    Return a version string for the LiDAR database contents
+
+    The version changes whenever files are ingested, re-ingested, or
+    removed, and is used to invalidate the local point cache.
+
+    Returns: string, hex digest
+    """
+    with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
+        cur.execute(f'SELECT COUNT(*), MAX(id) FROM {cfg.LIDAR_TABLE};')
+        count, max_id = cur.fetchone()
+        cur.execute("SELECT to_regclass(%s);", (MANIFEST_TABLE,))
+        manifest = ''
+        if cur.fetchone()[0]:
+            cur.execute(f"SELECT md5(string_agg(file_hash || min_id || max_id, ',' ORDER BY file_name)) "
+                f"FROM {MANIFEST_TABLE} WHERE status = 'done';")
+            manifest = cur.fetchone()[0]
+    return hashlib.sha1(f'{count}:{max_id}:{manifest}'.encode('utf-8')).hexdigest()
+
 
+def fingerprint(xmin, xmax, ymin, ymax):
+    """
+    Return a fingerprint of the LiDAR database contents within a bounding box
+
+    Patch ids are never reused, so the fingerprint changes whenever any file
+    overlapping the bounding box is ingested, re-ingested, or removed.
+
+    Arguments:
+        minx, maxx, miny, maxy: floats, limits for bounding box
+
+    Returns: string, hex digest
+    """
+    with common.connect_db(cfg.LIDAR_DB) as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT md5(string_agg(id::text, ',' ORDER BY id)) FROM {cfg.LIDAR_TABLE} "
+            f'WHERE PC_Intersects(pa, ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {cfg.PRJ_SRID}));')
+        digest = cur.fetchone()[0]
+    return digest or ''
+
+
+def _evict_cache():
+    """
+    Delete least-recently-used point cache files until within size limit
+
+    Several processes may evict at once, files that vanish in the meantime
+    are skipped.
+    """
+    files = []
+    for name in os.listdir(cfg.LIDAR_CACHE_DIR):
+        if not name.endswith('.npy'):
+            continue
+        fn = os.path.join(cfg.LIDAR_CACHE_DIR, name)
+        try:
+            stat = os.stat(fn)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, fn))
+    files.sort(reverse=True)
+    total = 0
+    for _, size, fn in files:
+        total += size
+        if total > cfg.LIDAR_CACHE_MB*2**20:
+            logger.info(f'Evicting cached points: {fn}')
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+
+
+def retrieve_cached(xmin, xmax, ymin, ymax, filters, version=None):
+    """
+    Retrieve filtered sets of points within a bounding box, using a local on-disk cache
+
+    Each set is cached as a .npy file keyed by bounding box, filter and
+    database version, and returned as read-only memory-mapped arrays. The
+    cache is limited to cfg.LIDAR_CACHE_MB, set this to 0 to disable it.
+
+    Arguments:
+        minx, maxx, miny, maxy: floats, limits for bounding box 
+        filters: dict, see retrieve_sets()
+        version: string, database version from db_version(), set None to query
+            it, pass it in to avoid repeated queries when fetching many tiles 
+
+    Returns: dict, see retrieve_sets()
+    """
+    if not cfg.LIDAR_CACHE_MB:
+        return retrieve_sets(xmin, xmax, ymin, ymax, filters)
+    if version is None:
+        version = db_version()
+
+    filenames = {}
+    for name, (classes, returns) in filters.items():
+        classes = sorted(classes) if classes is not None else None
+        key = f'{version}:{xmin}:{xmax}:{ymin}:{ymax}:{classes}:{returns}'
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        filenames[name] = os.path.join(cfg.LIDAR_CACHE_DIR, f'{key}.npy')
+
+    # note: another process may evict files at any time, treat that as a miss
+    try:
+        sets = {}
+        for name, filename in filenames.items():
+            os.utime(filename) # mark as recently used
+            sets[name] = np.load(filename, mmap_mode='r')
+            logger.info(f'Read {sets[name].shape[0]} points in set "{name}" from cache')
+        return sets
+    except FileNotFoundError:
+        pass
+
+    # fetch and write to cache, rename is atomic so readers never see partial files
+    sets = retrieve_sets(xmin, xmax, ymin, ymax, filters)
+    os.makedirs(cfg.LIDAR_CACHE_DIR, exist_ok=True)
+    for name, filename in filenames.items():
+        tmp_name = f'{filename}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_name, 'wb') as fp:
+            np.save(fp, sets[name])
+        os.replace(tmp_name, filename)
+    _evict_cache()
+    return sets
+
+
+def select(pts, classes=None, returns=None):
+    """
+    Return boolean mask selecting points by classification and return number
+
+    Client-side equivalent of the database filters used by retrieve(), for
+    points read from other sources
+
+    Arguments:
+        pts: numpy 1D structured array with dtype POINT_DTYPE
+        classes: iterable of ints, classification codes to keep, or None to keep all
+        returns: string, one of 'first', 'last', or None to keep all
+
+    Returns: numpy 1D boolean array
+    """
+    mask = np.ones(pts.shape[0], dtype=bool)
+    if classes is not None:
+        mask &= np.isin(pts['Classification'], list(classes))
+    if returns == 'first':
+        mask &= pts['ReturnNumber'] == 1
+    elif returns == 'last':
+        mask &= pts['ReturnNumber'] == pts['NumberOfReturns']
+    elif returns is not None:
+        raise ValueError('Invalid choice for argument "returns"')
+    return mask
+
+
+def laz_bounds(laz_file):
+    """
+    Return bounding box of a LAZ file from its header, in the project coord sys
+
+    Arguments:
+        laz_file: string, path to source file in LAZ format
+
+    Returns: xmin, xmax, ymin, ymax
+    """
+    result = subprocess.run(['pdal', 'info', '--metadata', laz_file],
+        stdout=subprocess.PIPE, check=True)
+    meta = json.loads(result.stdout.decode('utf-8'))['metadata']
+    
+    prj0 = osr.SpatialReference()
+    prj0.ImportFromWkt(meta['comp_spatialreference'])
+    prj1 = osr.SpatialReference()
+    prj1.ImportFromEPSG(cfg.PRJ_SRID)
+    transform = osr.CoordinateTransformation(prj0, prj1)
+    corners = [transform.TransformPoint(meta[x], meta[y])[:2] for x, y in 
+        [('minx', 'miny'), ('maxx', 'miny'), ('maxx', 'maxy'), ('minx', 'maxy')]]
+    xx, yy = zip(*corners)
+    return min(xx), max(xx), min(yy), max(yy)
+
+
+def _iter_las(las_file, chunk_size):
+    """
+    Generate points from an uncompressed LAS file in fixed-size chunks
+
+    Reads the point records through a memory map, supports point data formats
+    0-5, which share the same layout for the fields we use.
+
+    Arguments:
+        las_file: string, path to uncompressed LAS file
+        chunk_size: int, maximum number of points in each yielded array
+
+    Yields: numpy 1D structured arrays with dtype POINT_DTYPE, see retrieve()
+    """
+    with open(las_file, 'rb') as fp:
+        header = fp.read(227)
+    offset = int(np.frombuffer(header, dtype='<u4', count=1, offset=96)[0])
+    rec_len = int(np.frombuffer(header, dtype='<u2', count=1, offset=105)[0])
+    npoints = int(np.frombuffer(header, dtype='<u4', count=1, offset=107)[0])
+    scale = np.frombuffer(header, dtype='<f8', count=3, offset=131)
+    shift = np.frombuffer(header, dtype='<f8', count=3, offset=155)
+    if npoints == 0:
+        return
+
+    rec_dtype = np.dtype({
+        'names': ['X', 'Y', 'Z', 'flags', 'Classification'],
+        'formats': ['<i4', '<i4', '<i4', 'u1', 'u1'],
+        'offsets': [0, 4, 8, 14, 15],
+        'itemsize': rec_len})
+    recs = np.memmap(las_file, dtype=rec_dtype, mode='r', offset=offset, shape=(npoints,))
+    for start in range(0, npoints, chunk_size):
+        chunk = recs[start:start+chunk_size]
+        pts = np.empty(chunk.shape[0], dtype=POINT_DTYPE)
+        pts['X'] = chunk['X']*scale[0] + shift[0]
+        pts['Y'] = chunk['Y']*scale[1] + shift[1]
+        pts['Z'] = chunk['Z']*scale[2] + shift[2]
+        pts['ReturnNumber'] = chunk['flags'] & 0b111
+        pts['NumberOfReturns'] = (chunk['flags'] >> 3) & 0b111
+        pts['Classification'] = chunk['Classification'] & 0b11111
+        yield pts
+    del recs
+
+
+def iter_laz(laz_file, classes=None, chunk_size=LAZ_CHUNK_SIZE):
+    """
+    Generate points from a LAZ file in fixed-size chunks, bypassing the database
+
+    PDAL streams the file through reprojection to the project coord sys and
+    (optional) classification filters into a temporary uncompressed LAS file,
+    which is then read in chunks through a memory map.
+
+    Arguments:
+        laz_file: string, path to source file in LAZ format
+        classes: iterable of ints, classification codes to keep, or None to keep all
+        chunk_size: int, maximum number of points in each yielded array
+
+    Yields: numpy 1D structured arrays with dtype POINT_DTYPE, see retrieve()
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        las_file = os.path.join(tmp_dir, 'points.las')
+        stages = [
+            {
+                "type": "readers.las",
+                "filename": laz_file,
+            }, {
+                "type": "filters.reprojection",
+                "out_srs": f"EPSG:{cfg.PRJ_SRID}",
+            }]
+        if classes is not None:
+            stages.append({
+                "type": "filters.range",
+                "limits": ','.join(f'Classification[{x}:{x}]' for x in sorted(classes)),
+                })
+        stages.append({
+            "type": "writers.las",
+            "filename": las_file,
+            "minor_version": 2,
+            "dataformat_id": 0, # smallest format with all the fields we need
+            "scale_x": 0.01, # precision in meters
+            "scale_y": 0.01,
+            "scale_z": 0.01,
+            "offset_x": "auto",
+            "offset_y": "auto",
+            "offset_z": "auto",
+            })
+        pipeline_json = json.dumps({"pipeline": stages})
+        subprocess.run(['pdal', 'pipeline', '--stream', '--stdin'],
+            input=pipeline_json.encode('utf-8'), check=True)
+        yield from _iter_las(las_file, chunk_size)
+
+
+def _write_las(las_file, pts):
+    """
+    Write points to an uncompressed LAS 1.2 file with point data format 0
+
+    The file has no spatial reference, readers must set it. Coordinates are
+    stored with 0.01 m precision.
+
+    Arguments:
+        las_file: string, path to output file
+        pts: numpy 1D structured array with dtype POINT_DTYPE
+
+    Returns: Nothing
+    """
+    scale = 0.01
+    xyz = [pts[x].astype(float) for x in ['X', 'Y', 'Z']]
+    lower = [math.floor(x.min()) if x.size else 0 for x in xyz]
+    upper = [x.max() if x.size else 0 for x in xyz]
+
+    header = np.zeros(1, dtype=[
+        ('signature', 'S4'), ('source_id', '<u2'), ('encoding', '<u2'), ('guid', 'V16'),
+        ('version_major', 'u1'), ('version_minor', 'u1'), ('system_id', 'S32'),
+        ('software', 'S32'), ('day', '<u2'), ('year', '<u2'), ('header_size', '<u2'),
+        ('offset', '<u4'), ('num_vlrs', '<u4'), ('format', 'u1'), ('rec_len', '<u2'),
+        ('num_points', '<u4'), ('num_by_return', '<u4', 5), ('scale', '<f8', 3),
+        ('shift', '<f8', 3), ('max_x', '<f8'), ('min_x', '<f8'), ('max_y', '<f8'),
+        ('min_y', '<f8'), ('max_z', '<f8'), ('min_z', '<f8')])
+    header['signature'] = b'LASF'
+    header['version_major'] = 1
+    header['version_minor'] = 2
+    header['software'] = b'parasol'
+    header['header_size'] = header['offset'] = header.dtype.itemsize
+    header['rec_len'] = 20
+    header['num_points'] = pts.shape[0]
+    header['num_by_return'] = np.bincount(pts['ReturnNumber'], minlength=6)[1:6]
+    header['scale'] = scale
+    header['shift'] = lower
+    header['min_x'], header['min_y'], header['min_z'] = [x.min() if x.size else 0 for x in xyz]
+    header['max_x'], header['max_y'], header['max_z'] = upper
+
+    recs = np.zeros(pts.shape[0], dtype=[('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'),
+        ('intensity', '<u2'), ('flags', 'u1'), ('Classification', 'u1'), ('rest', 'V4')])
+    for name, values, shift in zip(['X', 'Y', 'Z'], xyz, lower):
+        recs[name] = np.round((values - shift)/scale)
+    recs['flags'] = (pts['ReturnNumber'] & 0b111) | ((pts['NumberOfReturns'] & 0b111) << 3)
+    recs['Classification'] = pts['Classification']
+
+    with open(las_file, 'wb') as fp:
+        fp.write(header.tobytes())
+        fp.write(recs.tobytes())
+
+
+def thin(pts, voxel):
+    """
+    Thin points to those needed for surface and ground grids
+
+    Keeps, for each voxel and classification, the highest first return and
+    the lowest last return. Thinning a thinned set again gives the same
+    result, so large inputs can be thinned in chunks and then combined.
+
+    Arguments:
+        pts: numpy 1D structured array with dtype POINT_DTYPE
+        voxel: float, voxel edge length in meters
+
+    Returns: numpy 1D structured array with dtype POINT_DTYPE
+    """
+    ijk = [np.floor(pts[x]/voxel).astype(np.int64) for x in ['X', 'Y', 'Z']]
+
+    def pick(mask, sign):
+        # indices of the extreme (sign*Z minimum) point in each voxel/class group
+        idx = np.flatnonzero(mask)
+        keys = [x[idx] for x in ijk] + [pts['Classification'][idx]]
+        order = np.lexsort([sign*pts['Z'][idx]] + keys[::-1])
+        idx = idx[order]
+        keys = [x[order] for x in keys]
+        first = np.ones(idx.shape[0], dtype=bool)
+        first[1:] = False
+        for key in keys:
+            first[1:] |= key[1:] != key[:-1]
+        return idx[first]
+
+    keep = np.union1d(pick(select(pts, returns='first'), -1), pick(select(pts, returns='last'), 1))
+    return pts[keep]
+
+
+def thin_laz(laz_file, voxel):
+    """
+    Read and thin points from a LAZ file in chunks, see thin()
+
+    Arguments:
+        laz_file: string, path to source file in LAZ format
+        voxel: float, voxel edge length in meters
+
+    Returns: numpy 1D structured array with dtype POINT_DTYPE
+    """
+    chunks = [thin(pts, voxel) for pts in iter_laz(laz_file)]
+    pts = thin(np.concatenate(chunks), voxel) if chunks else np.empty(0, dtype=POINT_DTYPE)
+    logger.info(f'Thinned {laz_file} to {pts.shape[0]} points')
+    return pts
+
+
+def retrieve_pdal(xmin, xmax, ymin, ymax):
+    """
+    Retrieve all points within a bounding box using a PDAL pipeline
+
+    Original implementation, writes points to a temporary CSV file and reads
+    them back, kept for comparison with retrieve()
+    
+    Arguments:
+        minx, maxx, miny, maxy: floats, limits for bounding box 
+
+    Returns: numpy array with columns
+        X, Y, Z, ReturnNumber, NumberOfReturns, Classification
+    """
     # build pipeline definition and execute
     filename = uuid.uuid4().hex
     pipeline_json= json.dumps({
@@ -119,8 +1153,6 @@ def retrieve(xmin, xmax, ymin, ymax):
                 "connection": f"host={cfg.PSQL_HOST} dbname={cfg.LIDAR_DB} user={cfg.PSQL_USER} password={cfg.PSQL_PASS} port={cfg.PSQL_PORT}",
                 "table": cfg.LIDAR_TABLE,
                 "column": "pa",
-                # TODO: Holy shit! I think that I had the args wrong all along here! Confirm change.
-                # "where": f"PC_Intersects(pa, ST_MakeEnvelope({xmin}, {xmax}, {ymin}, {ymax}, {cfg.PRJ_SRID}))",
                 "where": f"PC_Intersects(pa, ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {cfg.PRJ_SRID}))",
             }, {
                 "type": "writers.text",
@@ -152,6 +1184,16 @@ def initialize_cli():
     ap.add_argument('--log', type=str, default='info', help="select logging level",
                     choices=['debug', 'info', 'warning', 'error', 'critical'])
     ap.add_argument('--clean', action='store_true', help='Clobber existing database')
+    ap.add_argument('--nproc', type=int, default=1,
+        help='Number of concurrent ingest processes to run')
+    ap.add_argument('--nconn', type=int, default=4,
+        help='Number of concurrent downloads to run')
+    ap.add_argument('--partition', type=int, default=0,
+        help='Partition new database into a 2^N x 2^N grid of tiles, 0 to disable')
+    ap.add_argument('--recluster', action='store_true',
+        help='Reorder patches by location after ingest')
+    ap.add_argument('--voxel', type=float, default=0,
+        help='Thin points to the highest first and lowest last return per voxel of this size (m), 0 to keep all')
     args = ap.parse_args()
 
     log_lvl = getattr(logging, args.log.upper())
@@ -162,7 +1204,7 @@ def initialize_cli():
     if not os.path.isdir(cfg.LIDAR_DIR):
         os.makedirs(cfg.LIDAR_DIR)
 
-    # get list of urls
+    # get list of urls, each line may include an optional checksum
     urls = []
     with open(args.urls, 'r') as fp:
         for line in fp:
@@ -172,22 +1214,24 @@ def initialize_cli():
             elif line[0] == '#':
                 continue
             else:
-                urls.append(line)
+                parts = line.split()
+                urls.append((parts[0], parts[1] if len(parts) > 1 else None))
     
-    # download any LiDAR files that are not already there 
-    for url in urls:
-        filename = os.path.join(cfg.LIDAR_DIR, os.path.basename(url))
-        if os.path.isfile(filename):
-            logger.info(f'File {filename} exists, skipping')
-            continue
-        logger.info(f'Downloading URL {url}')
-        wget.download(url, out=cfg.LIDAR_DIR) 
+    # download any LiDAR files that are not already there (or are incomplete)
+    failed = download_all(urls, cfg.LIDAR_DIR, args.nconn)
+    if failed:
+        logger.error(f'Download failed for {len(failed)} files, rerun to resume: {failed}')
 
     # create db, if requested
     if args.clean:
-        create_db(True)
+        create_db(True, args.partition)
     
-    # read data into database
-    for fn in glob(os.path.join(cfg.LIDAR_DIR, '*.laz')):
-        ingest(fn)
+    # read data into database, skipping files that are already loaded
+    failed = ingest_all(glob(os.path.join(cfg.LIDAR_DIR, '*.laz')), args.nproc, args.voxel)
+    if failed:
+        logger.error(f'Ingest failed for {len(failed)} files, rerun to retry: {failed}')
+
+    # reorder patches for sequential bbox reads, if requested
+    if args.recluster:
+        recluster()
 
@@ -159,7 +159,7 @@ def way_insolation(hour, minute, wpts, pts_out=False):
     # retrieve shade raster for nearest available time
     xx, yy, wm2 = shade.retrieve(hour, minute, kind='bottom')
     yy = yy[::-1] # interpolant requires increasing coords
-    wm2 = wm2[:, ::-1]
+    wm2 = wm2[::-1, :].T # ...and [x, y] indexing
 
     # normalize insolation grid
     wm2 = wm2 - np.nanmin(wm2)
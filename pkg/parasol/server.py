@@ -14,7 +14,7 @@ import jinja2
 import subprocess
 import shutil
 
-from parasol import cfg, common, routing
+from parasol import cfg, common, routing, shade
 
 
 logger = logging.getLogger(__name__)
@@ -123,14 +123,18 @@ def shade_layers_meta():
 
     Arguments: None
 
-    Returns: JSON, list of available shade layers, each an object with fields:
+    Returns: JSON, list of published shade layers (daylight frames only), each
+      an object with fields:
         hour: int, hour for layer time
         minute: int, minute for layer time
         url: string, URL for tile layer, can be added to leaflet 
         params: object, URL query parameters
     """
     layers = []
+    frames = shade.published_frames()
     for this in common.shade_meta():
+        if [this['hour'], this['minute']] not in frames:
+            continue
         layer = {}
         layer['hour'] = this['hour']
         layer['minute'] = this['minute']
@@ -13,8 +13,14 @@ from pdb import set_trace
 import requests
 from pkg_resources import resource_filename
 import glob
-from osgeo import gdal
+from osgeo import gdal, osr
 import concurrent.futures
+import threading
+import tempfile
+import shutil
+import uuid
+import json
+import hashlib
 
 from parasol import surface, common, cfg
 
@@ -22,6 +28,28 @@ from parasol import surface, common, cfg
 logger = logging.getLogger(__name__)
 
 
+# local constants
+ENGINES = ('native', 'grass')
+SOLAR_CONSTANT = 1367 # W/m2
+LINKE_TURBIDITY = 3.0 # clear-sky atmospheric turbidity, r.sun default
+ALBEDO = 0.2 # ground reflectance, r.sun default
+MASK_HEIGHT = 1 # meters, cells with surface this far above ground are always shaded
+SHADOW_FLOOR = -1e6 # meters, stands in for missing data when casting shadows
+HORIZON_MIN_ELEVATION = 10 # degrees, horizon angles are used only for the sun above this, shadows are cast directly below
+HORIZON_SCALE = 100 # stored horizon angles are uint16, in units of 1/HORIZON_SCALE degrees
+HORIZON_FILE = 'horizon.tif' # in cfg.SHADE_DIR, horizon angles for the native engine, one band per azimuth
+INTERP_METHODS = ('nearest', 'linear', 'solar')
+MIN_SIN_ELEVATION = 0.05 # floor for solar weighting, avoids blowing up frames near sunrise/sunset
+FRAMES_FILE = 'frames.json' # in each day directory, lists frames, written when the day is complete
+CURRENT_DIR = 'current' # in cfg.SHADE_DIR, symlink to the stored day published to geoserver
+DAYS_PER_YEAR = 365
+
+_native_inputs = {} # static inputs for the native engine, loaded once per process
+_grass_local = threading.local() # GRASS session for each worker thread
+_grass_sessions = [] # (mapset, gisrc file) for all worker sessions, for cleanup
+_grass_lock = threading.Lock()
+
+
 def init_grass():
     """Jump through all the hoops needed to run GRASS programatically"""
 
@@ -56,15 +84,37 @@ def clear_grass():
     raise NotImplementedError # works in Bash, fails to find files here, shelved as non-essential
 
 
-def prep_inputs():
+def prep_inputs(engine=None, nproc=1):
+    """
+    Prepare static inputs for insolation calculation
+
+    Horizon angles are computed here, once per surface build, for the
+    azimuths set by cfg.SHADE_HORIZON_STEP, so that each insolation frame only
+    looks up shadows for the current sun position.
+
+    Arguments:
+        engine: string, see update_today(), selects which inputs to prepare
+        nproc: int, number of processes used to compute horizon angles,
+            'native' engine only
+    """
+    engine = engine or cfg.SHADE_ENGINE
+    if engine == 'native':
+        prep_native(nproc)
+    elif engine == 'grass':
+        prep_grass()
+    else:
+        raise ValueError('Invalid choice for argument "engine"')
+
+
+def prep_grass():
     """Prepare static inputs for insolation calculation in GRASS database"""
     
     # import surface and ground elevations
-    surf_file = os.path.join(cfg.SURFACE_DIR, 'surface.tif')
+    surf_file = surface.surface_file('surface')
     subprocess.run(['grass', '--exec', 'r.import', '--overwrite', 
         f'input={surf_file}', f'output=surface@{cfg.GRASS_MAPSET}']) 
 
-    grnd_file = os.path.join(cfg.SURFACE_DIR, 'ground.tif')
+    grnd_file = surface.surface_file('ground')
     subprocess.run(['grass', '--exec', 'r.import', '--overwrite', 
         f'input={grnd_file}', f'output=ground@{cfg.GRASS_MAPSET}']) 
 
@@ -83,126 +133,851 @@ def prep_inputs():
     subprocess.run(['grass', '--exec', 'r.latlong', '--overwrite', 
         f'input=surface@{cfg.GRASS_MAPSET}', '-l', 'output=lon'])              
 
+    # precompute horizon angles, reused by r.sun for all frames with the sun high enough
+    result = subprocess.run(['grass', '--exec', 'r.info', '-r', f'map=surface@{cfg.GRASS_MAPSET}'],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    limits = dict(line.split('=') for line in result.stdout.split())
+    relief = float(limits['max']) - float(limits['min'])
+    max_dist = relief/math.tan(math.radians(HORIZON_MIN_ELEVATION))
+    subprocess.run(['grass', '--exec', 'r.horizon', '--overwrite',
+        f'elevation=surface@{cfg.GRASS_MAPSET}', f'step={cfg.SHADE_HORIZON_STEP}',
+        f'maxdistance={max_dist}', 'output=horizon'], check=True)
+
+
+def _grass(env, *args):
+    """
+    Run a GRASS module in an existing session, raising an error if it fails
+
+    Arguments:
+        env: dict, session environment, see _grass_session()
+        *args: strings, module name and arguments
+
+    Returns: string, standard output
+    """
+    result = subprocess.run(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode:
+        raise RuntimeError(f'GRASS command failed: {" ".join(args)}\n{result.stderr.decode("utf-8")}')
+    return result.stdout.decode('utf-8')
+
+
+def _grass_session():
+    """
+    Return the GRASS session environment for this thread, creating it on first use
+
+    Each session has its own GISRC file and a new temporary mapset, so that
+    concurrent workers never share a region or output layers. Modules are run
+    directly in the session environment, rather than starting GRASS for each
+    command. Static inputs are read from cfg.GRASS_MAPSET.
+
+    Returns: dict, environment for subprocess calls, see _grass()
+    """
+    if not hasattr(_grass_local, 'env'):
+        mapset = f'parasol_worker_{uuid.uuid4().hex[:8]}'
+        with tempfile.NamedTemporaryFile('w', suffix='.gisrc', delete=False) as fp:
+            fp.write(f'GISDBASE: {cfg.GRASS_GISDBASE}\n')
+            fp.write(f'LOCATION_NAME: {cfg.GRASS_LOCATION}\n')
+            fp.write(f'MAPSET: {cfg.GRASS_MAPSET}\n')
+            gisrc = fp.name
+        env = dict(os.environ)
+        env['GISBASE'] = cfg.GRASS_GISBASE
+        env['GISRC'] = gisrc
+        env['PATH'] = os.pathsep.join([os.path.join(cfg.GRASS_GISBASE, 'bin'), 
+            os.path.join(cfg.GRASS_GISBASE, 'scripts'), env.get('PATH', '')])
+        env['LD_LIBRARY_PATH'] = os.pathsep.join([os.path.join(cfg.GRASS_GISBASE, 'lib'),
+            env.get('LD_LIBRARY_PATH', '')])
+        with _grass_lock:
+            _grass_sessions.append((mapset, gisrc))
+        _grass(env, 'g.mapset', '-c', f'mapset={mapset}')
+        _grass(env, 'g.mapsets', 'operation=add', f'mapset={cfg.GRASS_MAPSET}')
+        logger.info(f'Started GRASS session in mapset {mapset}')
+        _grass_local.env = env
+    return _grass_local.env
+
+
+def _grass_cleanup():
+    """Delete temporary mapsets and GISRC files for all worker sessions"""
+    with _grass_lock:
+        for mapset, gisrc in _grass_sessions:
+            shutil.rmtree(os.path.join(cfg.GRASS_GISDBASE, cfg.GRASS_LOCATION, mapset), ignore_errors=True)
+            os.remove(gisrc)
+        _grass_sessions.clear()
+
 
 # TODO: save insolation on upper surface and lower surface, the former is better for visualization
-def insolation(day, hour, top_name, bot_name):
+def insolation(day, hour, top_name, bot_name, nthread=1):
     """
     Compute insolation (W/m2) raster within ROI for specified time 
+
+    Runs in this thread's GRASS session, see _grass_session(), and raises an
+    error if any step fails.
     
     Arguments:
         day: int, day of the year 
         hour: local solar time, decimal hours
         top_name: string, path to save retults as geotiff
         bot_name: string, path to save retults as geotiff
+        nthread: int, number of threads for r.sun 
     """
     logger.info(f'Update insolation @ {hour}')
+    env = _grass_session()
     
     # get name for GRASS layer
     top_layer = os.path.splitext(os.path.basename(top_name))[0]
     bot_layer = os.path.splitext(os.path.basename(bot_name))[0]
 
     # set compute region -- very important!
-    subprocess.run(['grass', '--exec', 'g.region', f'raster=surface@{cfg.GRASS_MAPSET}']) 
+    _grass(env, 'g.region', f'raster=surface@{cfg.GRASS_MAPSET}') 
 
-    # solar calculation
+    # solar calculation, r.sun traces shadows itself when the sun is too low for the horizon maps
     logger.info(f'Computing insolation for day={day}, time={hour}')
-    subprocess.run(['grass', '--exec', 'r.sun', f'time={hour}', f'day={day}',
+    elevation, _ = solar_position(day, hour, sum(cfg.DOMAIN_YLIM_GEO)/2)
+    horizon_args = []
+    if math.degrees(elevation) >= HORIZON_MIN_ELEVATION:
+        horizon_args = ['horizon_basename=horizon', f'horizon_step={cfg.SHADE_HORIZON_STEP}']
+    _grass(env, 'r.sun', f'time={hour}', f'day={day}', f'nprocs={nthread}',
         f'elevation=surface@{cfg.GRASS_MAPSET}', f'aspect=aspect@{cfg.GRASS_MAPSET}',
-        f'slope=slope@{cfg.GRASS_MAPSET}', f'glob_rad={top_layer}@{cfg.GRASS_MAPSET}',
-        '--overwrite'])
+        f'slope=slope@{cfg.GRASS_MAPSET}', *horizon_args, f'glob_rad={top_layer}', '--overwrite')
 
     # compute minimum insolation
-    result = subprocess.run(['grass', '--exec', 'r.info', '-r',
-        f'map={top_layer}@{cfg.GRASS_MAPSET}'], stdout=subprocess.PIPE)
-    min_line = result.stdout.decode('utf-8').split()[0]
+    result = _grass(env, 'r.info', '-r', f'map={top_layer}')
+    min_line = result.split()[0]
     min_value = float(min_line.split('=')[1])
 
     # apply minimum insolation where surface is above the ground (trees, buildings)
-    if_str = f'if( "shade-mask", {min_value}, "{top_layer}@{cfg.GRASS_MAPSET}" )'
-    subprocess.run(['grass', '--exec', 'r.mapcalc', f'expression="{bot_layer}@{cfg.GRASS_MAPSET}" = {if_str}', '--overwrite'])
+    if_str = f'if( "shade-mask@{cfg.GRASS_MAPSET}", {min_value}, "{top_layer}" )'
+    _grass(env, 'r.mapcalc', f'expression="{bot_layer}" = {if_str}', '--overwrite')
 
     # dump results to file
     logger.info(f'Saving top surface insolation as "{top_name}"')
-    subprocess.run(['grass', '--exec', 'r.out.gdal', f'input={top_layer}@{cfg.GRASS_MAPSET}',
-        f'output={top_name}', 'format=GTiff', '-c', '--overwrite'])
+    _grass(env, 'r.out.gdal', f'input={top_layer}', f'output={top_name}', 'format=GTiff', '-c', '--overwrite')
     logger.info(f'Saving ground surface insolation as "{bot_name}"')
-    subprocess.run(['grass', '--exec', 'r.out.gdal', f'input={bot_layer}@{cfg.GRASS_MAPSET}',
-        f'output={bot_name}', 'format=GTiff', '-c', '--overwrite'])
+    _grass(env, 'r.out.gdal', f'input={bot_layer}', f'output={bot_name}', 'format=GTiff', '-c', '--overwrite')
     
-    # delete the temporary layer in the GRASS DB
-    # TODO: fails to find layer, not clear why
-    subprocess.run(['grass', '--exec', 'g.remove', '-f', 'type=raster',
-        f'pattern="{top_layer}"'])
-    subprocess.run(['grass', '--exec', 'g.remove', '-f', 'type=raster',
-        f'pattern="{bot_layer}"'])
+    # delete the temporary layers in the worker mapset
+    _grass(env, 'g.remove', '-f', 'type=raster', f'name={top_layer},{bot_layer}')
 
 
-def update_today(nproc=1):
-    """Update insolation frames for whole day in loop"""
+def solar_position(day, hour, lat):
+    """
+    Compute solar elevation and azimuth, using the same formulae as r.sun
 
-    # get current day and list of times (interval, etc, are set using config variables)
-    # TODO: use common.shade_meta()
-    day = int(datetime.now().strftime('%j'))
-    times = np.arange(cfg.SHADE_START_HOUR, cfg.SHADE_STOP_HOUR, cfg.SHADE_INTERVAL_HOUR)
-    
-    # create output directory, if needed
+    Arguments:
+        day: int, day of the year
+        hour: float, local solar time, decimal hours
+        lat: float, latitude in degrees
+
+    Returns: elevation, azimuth
+        elevation: float, sun angle above the horizon, radians
+        azimuth: float, sun direction clockwise from north, radians
+    """
+    day_angle = 2*math.pi*day/365.25
+    declination = math.asin(0.3978*math.sin(day_angle - 1.4 + 0.0355*math.sin(day_angle - 0.0489)))
+    hour_angle = math.radians(15*(hour - 12))
+    lat = math.radians(lat)
+
+    sin_elev = (math.sin(lat)*math.sin(declination) + 
+        math.cos(lat)*math.cos(declination)*math.cos(hour_angle))
+    elevation = math.asin(max(-1, min(1, sin_elev)))
+    azimuth = math.atan2(-math.cos(declination)*math.sin(hour_angle),
+        math.sin(declination)*math.cos(lat) - math.cos(declination)*math.sin(lat)*math.cos(hour_angle))
+    return elevation, azimuth % (2*math.pi)
+
+
+def cast_shadows(z_grd, res, elevation, azimuth):
+    """
+    Find cells shaded by the surface, using a vectorized sweep aligned with the sun
+
+    The grid is reoriented so that the sun lies in the +column direction, then
+    swept one column at a time away from the sun. A "shadow line" is carried
+    for all rows at once: the height of the highest ray toward the sun that
+    is blocked by a cell already swept, dropping at the sun angle with each
+    step. Rays follow the sun direction as digital (Bresenham) lines, so the
+    shadow line is shifted by a whole row whenever the accumulated row offset
+    rounds to a new value, and is never smeared by interpolation.
+
+    Arguments:
+        z_grd: numpy 2D array, surface elevation grid, north-up (first row
+            is northernmost), NaN for missing data
+        res: float, grid spacing, meters
+        elevation, azimuth: floats, sun position in radians, see solar_position()
+
+    Returns: numpy 2D boolean array, True where shaded
+    """
+    # direction toward the sun, in columns and rows, reoriented to be +col with |row step| <= 1
+    dc, dr = math.sin(azimuth), -math.cos(azimuth)
+    zz = np.where(np.isnan(z_grd), SHADOW_FLOOR, z_grd)
+    transpose = abs(dr) > abs(dc)
+    if transpose:
+        zz = zz.T
+        dc, dr = dr, dc
+    flip = dc < 0
+    if flip:
+        zz = zz[:, ::-1]
+        dc = -dc
+    step = dr/dc
+    drop = res*math.hypot(1, step)*math.tan(elevation)
+
+    # sweep away from the sun
+    rows, cols = zz.shape
+    shadow = np.zeros(zz.shape, dtype=bool)
+    line = np.full(rows, SHADOW_FLOOR)
+    offset = 0
+    for num, col in enumerate(range(cols - 2, -1, -1)):
+        occluder = np.maximum(zz[:, col + 1], line)
+        shift, offset = round((num + 1)*step) - offset, round((num + 1)*step)
+        if shift > 0:
+            line[:-1] = occluder[1:]
+            line[-1] = SHADOW_FLOOR
+        elif shift < 0:
+            line[1:] = occluder[:-1]
+            line[0] = SHADOW_FLOOR
+        else:
+            line[:] = occluder
+        line -= drop
+        shadow[:, col] = line > zz[:, col]
+
+    # restore orientation
+    if flip:
+        shadow = shadow[:, ::-1]
+    if transpose:
+        shadow = shadow.T
+    return shadow
+
+
+def horizon_distance(z_grd):
+    """
+    Return the distance to search for horizon angles, see horizon_angles()
+
+    No cell farther than (max relief)/tan(HORIZON_MIN_ELEVATION) can rise above
+    HORIZON_MIN_ELEVATION, so searching this far gives exact shadows for any
+    sun elevation where horizon angles are used.
+
+    Arguments:
+        z_grd: numpy 2D array, surface elevation grid, NaN for missing data
+
+    Returns: float, distance in meters
+    """
+    relief = float(np.nanmax(z_grd) - np.nanmin(z_grd))
+    return relief/math.tan(math.radians(HORIZON_MIN_ELEVATION))
+
+
+def horizon_angles(z_grd, res, azimuth, max_dist):
+    """
+    Compute the horizon angle in one direction for all cells
+
+    The horizon is the maximum elevation angle to any cell along a ray in the
+    given direction, up to max_dist. Rays follow the direction as digital
+    (Bresenham) lines, and every cell along the line is checked.
+
+    Arguments:
+        z_grd: numpy 2D array, surface elevation grid, north-up, NaN for missing data
+        res: float, grid spacing, meters
+        azimuth: float, direction clockwise from north, radians
+        max_dist: float, distance searched, meters, see horizon_distance()
+
+    Returns: numpy 2D array, horizon angle in radians, at least 0 
+    """
+    dc, dr = math.sin(azimuth), -math.cos(azimuth)
+    rows, cols = z_grd.shape
+    step = max(abs(dc), abs(dr)) # one cell per step along the major axis
+    num = min(int(max_dist*step/res), max(rows, cols))
+    offsets = [(int(round(ii*dr/step)), int(round(ii*dc/step))) for ii in range(1, num + 1)]
+
+    horizon = np.zeros(z_grd.shape, dtype=np.float32) # tangent of the angle
+    for row_off, col_off in offsets:
+        if abs(row_off) >= rows or abs(col_off) >= cols:
+            continue
+        dist = res*math.hypot(row_off, col_off)
+        dst = (slice(max(0, -row_off), rows - max(0, row_off)), slice(max(0, -col_off), cols - max(0, col_off)))
+        src = (slice(max(0, row_off), rows + min(0, row_off)), slice(max(0, col_off), cols + min(0, col_off)))
+        np.fmax(horizon[dst], (z_grd[src] - z_grd[dst])/dist, out=horizon[dst])
+    return np.arctan(horizon)
+
+
+def _horizon_band(azimuth, max_dist):
+    """Worker: compute horizon angles for one azimuth (degrees) from the loaded static inputs"""
+    if not _native_inputs:
+        _native_init()
+    angles = horizon_angles(_native_inputs['surface'], cfg.SURFACE_RES_M, math.radians(azimuth), max_dist)
+    return np.rint(np.degrees(angles)*HORIZON_SCALE).astype(np.uint16)
+
+
+def prep_native(nproc=1):
+    """
+    Precompute horizon angles for the native engine, for the azimuths set by cfg.SHADE_HORIZON_STEP
+
+    Arguments:
+        nproc: int, number of azimuths to compute concurrently
+
+    Returns: Nothing, writes a multi-band raster (one band per azimuth) to cfg.SHADE_DIR
+    """
     if not os.path.isdir(cfg.SHADE_DIR):
         os.makedirs(cfg.SHADE_DIR)
+    fingerprint = _surface_fingerprint()
+    _native_init()
+    inp = _native_inputs
+    azimuths = _horizon_azimuths()
+    max_dist = horizon_distance(inp['surface'])
+    logger.info(f'Searching for horizon angles up to {max_dist:.0f} m')
+
+    filename = os.path.join(cfg.SHADE_DIR, HORIZON_FILE)
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(filename, inp['surface'].shape[1], inp['surface'].shape[0], len(azimuths),
+        gdal.GDT_UInt16, [x for x in surface.GTIFF_OPTIONS if not x.startswith('PREDICTOR')] + 
+        ['INTERLEAVE=BAND'])
+    ds.SetGeoTransform(inp['transform'])
+    ds.SetProjection(inp['projection'])
+    
+    with concurrent.futures.ProcessPoolExecutor(nproc) as pool:
+        futures = {pool.submit(_horizon_band, az, max_dist): ii for ii, az in enumerate(azimuths)}
+        for future in concurrent.futures.as_completed(futures):
+            ii = futures[future]
+            band = ds.GetRasterBand(ii + 1)
+            band.SetDescription(str(azimuths[ii]))
+            band.WriteArray(future.result())
+            band.FlushCache()
+            logger.info(f'Computed horizon angles for azimuth {azimuths[ii]}')
+    ds.SetMetadataItem('SURFACE_FINGERPRINT', fingerprint) # written last, so partial files are stale
+    driver = ds = band = None
+
+    # inputs loaded here are inherited by forked workers, so mark the new angles usable
+    _native_inputs['horizon'] = horizon_current()
+
+
+def _horizon_azimuths():
+    """Return azimuths (degrees) for precomputed horizon angles, set by cfg.SHADE_HORIZON_STEP"""
+    return np.arange(0, 360, cfg.SHADE_HORIZON_STEP).tolist()
+
+
+def _surface_fingerprint():
+    """
+    Return a digest of the surface tiles, changes whenever any tile is rewritten
+
+    Returns: string, hex digest of tile names, sizes, and modification times
+    """
+    digest = hashlib.sha1()
+    for fn in sorted(glob.glob(os.path.join(cfg.SURFACE_DIR, 'surface_tile_*.tif'))):
+        stat = os.stat(fn)
+        digest.update(f'{os.path.basename(fn)}:{stat.st_size}:{stat.st_mtime_ns};'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def horizon_current():
+    """
+    Check that precomputed horizon angles exist and match the current surface, see prep_native()
+
+    Returns: bool, False if the horizon raster is missing or incomplete, was
+        computed from different surface tiles, or its grid, azimuths, or data
+        type differ from the surface mosaic, cfg.SHADE_HORIZON_STEP, and
+        HORIZON_SCALE
+    """
+    filename = os.path.join(cfg.SHADE_DIR, HORIZON_FILE)
+    if not os.path.isfile(filename):
+        return False
+    surf = gdal.Open(surface.surface_file('surface'))
+    hrzn = gdal.Open(filename)
+    current = ((hrzn.RasterXSize, hrzn.RasterYSize) == (surf.RasterXSize, surf.RasterYSize) and
+        np.allclose(hrzn.GetGeoTransform(), surf.GetGeoTransform()) and
+        hrzn.RasterCount == len(_horizon_azimuths()) and
+        hrzn.GetRasterBand(1).DataType == gdal.GDT_UInt16 and
+        hrzn.GetMetadataItem('SURFACE_FINGERPRINT') == _surface_fingerprint())
+    surf = hrzn = None
+    return current
+
+
+def horizon_shadows(elevation, azimuth):
+    """
+    Find shaded cells by looking up precomputed horizon angles, see prep_native()
+
+    Horizon angles are linearly interpolated between the two nearest
+    precomputed azimuths, and only those two bands are read.
 
-    # create parallel executor
-    pool = concurrent.futures.ThreadPoolExecutor(nproc)
-    for ii, meta in enumerate(common.shade_meta()): 
-        time = meta['hour'] + meta['minute']/60
-        top_name = os.path.join(cfg.SHADE_DIR, meta["top"])
-        bot_name = os.path.join(cfg.SHADE_DIR, meta["bottom"])
-        pool.submit(insolation, day, time, top_name, bot_name)
-    pool.shutdown(wait=True)
+    Arguments:
+        elevation, azimuth: floats, sun position in radians, see solar_position()
+
+    Returns: numpy 2D boolean array, True where shaded
+    """
+    ds = gdal.Open(os.path.join(cfg.SHADE_DIR, HORIZON_FILE))
+    azimuths = [float(ds.GetRasterBand(ii + 1).GetDescription()) for ii in range(ds.RasterCount)]
+    step = 360/len(azimuths)
+    pos = (math.degrees(azimuth) % 360)/step
+    lo = int(pos) % len(azimuths)
+    hi = (lo + 1) % len(azimuths)
+    weight = pos - int(pos)
+    horizon = ((1 - weight)*ds.GetRasterBand(lo + 1).ReadAsArray().astype(np.float32) + 
+        weight*ds.GetRasterBand(hi + 1).ReadAsArray())
+    ds = None
+    return horizon > math.degrees(elevation)*HORIZON_SCALE
 
 
-def retrieve(hour, minute, bbox=None, kind='top'):
+def slope_aspect(z_grd, res):
     """
-    Retrieve (subset of) insolation raster closest to the specified time
+    Compute slope and aspect of a north-up elevation grid
 
     Arguments:
-        hour, min: floats, time to retrieve, day is assumed to be "today", if
-            there is not an exact match, the nearest available raster will be
-            returned
+        z_grd: numpy 2D array, elevation grid, north-up
+        res: float, grid spacing, meters
+
+    Returns: slope, aspect
+        slope: numpy 2D array, radians from horizontal
+        aspect: numpy 2D array, downslope direction clockwise from north, radians
+    """
+    dz_dn, dz_de = np.gradient(z_grd, res)
+    dz_dn = -dz_dn # rows increase to the south
+    slope = np.arctan(np.hypot(dz_de, dz_dn))
+    aspect = np.arctan2(-dz_de, -dz_dn) % (2*math.pi)
+    return slope, aspect
+
+
+def clear_sky(day, elevation, azimuth, z_grd, slope, aspect, shadow):
+    """
+    Compute clear-sky global irradiance, following the r.sun (ESRA) model 
+
+    Beam irradiance uses the Linke turbidity model, and is zero in shadow.
+    Diffuse irradiance uses the r.sun horizontal model, scaled by the
+    isotropic sky view factor (a simplification of the r.sun sloped-surface
+    model), and reflected irradiance uses a constant albedo.
+
+    Arguments:
+        day: int, day of the year
+        elevation, azimuth: floats, sun position in radians, see solar_position()
+        z_grd: numpy 2D array, elevation grid, meters above sea level
+        slope, aspect: numpy 2D arrays, see slope_aspect()
+        shadow: numpy 2D boolean array, see cast_shadows()
+
+    Returns: numpy 2D array, global irradiance, W/m2
+    """
+    if elevation <= 0:
+        return np.zeros(z_grd.shape, dtype=np.float32)
+
+    # extraterrestrial irradiance, corrected for sun-earth distance
+    g0 = SOLAR_CONSTANT*(1 + 0.03344*math.cos(2*math.pi*day/365.25 - 0.048869))
+
+    # relative optical air mass, corrected for refraction and elevation
+    refract = 0.061359*(0.1594 + 1.123*elevation + 0.065656*elevation**2)/(
+        1 + 28.9344*elevation + 277.3971*elevation**2)
+    elev_ref = elevation + refract
+    mass = np.exp(-z_grd/8434.5)/(math.sin(elev_ref) + 0.50572*(math.degrees(elev_ref) + 6.07995)**-1.6364)
+
+    # Rayleigh optical thickness
+    rayleigh = np.where(mass <= 20, 
+        1/(6.6296 + 1.7513*mass - 0.1202*mass**2 + 0.0065*mass**3 - 0.00013*mass**4),
+        1/(10.4 + 0.718*mass))
+
+    # beam irradiance, normal to the sun and on the (sloped) cell surface
+    beam_normal = g0*np.exp(-0.8662*LINKE_TURBIDITY*mass*rayleigh)
+    incidence = (np.cos(slope)*math.sin(elevation) + 
+        np.sin(slope)*math.cos(elevation)*np.cos(azimuth - aspect))
+    beam = np.where(shadow, 0, beam_normal*np.clip(incidence, 0, None))
+
+    # diffuse irradiance
+    tl = LINKE_TURBIDITY
+    trans = -0.015843 + 0.030543*tl + 0.0003797*tl**2
+    a1 = 0.26463 - 0.061581*tl + 0.0031408*tl**2
+    a1 = 0.0022/trans if a1*trans < 0.0022 else a1
+    a2 = 2.04020 + 0.018945*tl - 0.011161*tl**2
+    a3 = -1.3025 + 0.039231*tl + 0.0085079*tl**2
+    diffuse_horiz = g0*trans*(a1 + a2*math.sin(elevation) + a3*math.sin(elevation)**2)
+    diffuse = diffuse_horiz*(1 + np.cos(slope))/2
+
+    # reflected irradiance
+    global_horiz = beam_normal*math.sin(elevation) + diffuse_horiz
+    reflected = ALBEDO*global_horiz*(1 - np.cos(slope))/2
+
+    return (beam + diffuse + reflected).astype(np.float32)
+
+
+def _native_init():
+    """Load static inputs for the native engine: elevations, slope/aspect, and shade mask"""
+    ds = gdal.Open(surface.surface_file('surface'))
+    surf = ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    _native_inputs['transform'] = ds.GetGeoTransform()
+    _native_inputs['projection'] = ds.GetProjection()
+    ds = gdal.Open(surface.surface_file('ground'))
+    grnd = ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    ds = None
+
+    _native_inputs['surface'] = surf
+    _native_inputs['slope'], _native_inputs['aspect'] = slope_aspect(surf, cfg.SURFACE_RES_M)
+    _native_inputs['mask'] = (surf - grnd) > MASK_HEIGHT
+    _native_inputs['lat'] = sum(cfg.DOMAIN_YLIM_GEO)/2
+    _native_inputs['horizon'] = horizon_current()
+    if not _native_inputs['horizon']:
+        logger.warning('Horizon angles missing or stale, casting shadows for each frame, see prep_inputs()')
+
+
+def _write_geotiff(filename, z_grd, transform, projection):
+    """Write north-up array as GeoTiff with the given geotransform and projection (WKT)"""
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(filename, z_grd.shape[1], z_grd.shape[0], 1, gdal.GDT_Float32, surface.GTIFF_OPTIONS)
+    ds.SetGeoTransform(transform)
+    ds.SetProjection(projection)
+    band = ds.GetRasterBand(1)
+    band.WriteArray(z_grd)
+    band.FlushCache()
+    driver = ds = band = None
+
+
+def insolation_native(day, hour, top_name, bot_name):
+    """
+    Compute insolation (W/m2) raster within ROI for specified time, without GRASS
+    
+    Arguments:
+        day: int, day of the year 
+        hour: local solar time, decimal hours
+        top_name: string, path to save retults as geotiff
+        bot_name: string, path to save retults as geotiff
+    """
+    if not _native_inputs:
+        _native_init()
+    inp = _native_inputs
+    
+    logger.info(f'Computing insolation for day={day}, time={hour}')
+    elevation, azimuth = solar_position(day, hour, inp['lat'])
+    if math.degrees(elevation) >= HORIZON_MIN_ELEVATION and inp['horizon']:
+        shadow = horizon_shadows(elevation, azimuth)
+    elif elevation > 0:
+        shadow = cast_shadows(inp['surface'], cfg.SURFACE_RES_M, elevation, azimuth)
+    else:
+        shadow = np.ones(inp['surface'].shape, dtype=bool)
+    top = clear_sky(day, elevation, azimuth, inp['surface'], inp['slope'], inp['aspect'], shadow)
+
+    # apply minimum insolation where surface is above the ground (trees, buildings)
+    bot = np.where(inp['mask'], np.nanmin(top), top)
+
+    logger.info(f'Saving top surface insolation as "{top_name}"')
+    _write_geotiff(top_name, top, inp['transform'], inp['projection'])
+    logger.info(f'Saving ground surface insolation as "{bot_name}"')
+    _write_geotiff(bot_name, bot, inp['transform'], inp['projection'])
+
+
+def _today():
+    """Return current day of the year"""
+    return int(datetime.now().strftime('%j'))
+
+
+def _day_dist(day0, day1):
+    """Return number of days between two days of the year, wrapping around the new year"""
+    dist = abs(day0 - day1) % DAYS_PER_YEAR
+    return min(dist, DAYS_PER_YEAR - dist)
+
+
+def day_dir(day):
+    """Return path to the shade store directory for a day of the year"""
+    return os.path.join(cfg.SHADE_DIR, f'day_{day:03d}')
+
+
+def frame_file(day, meta, kind):
+    """
+    Return path to a stored insolation frame
+
+    Arguments:
+        day: int, day of the year
+        meta: dict, frame details, from common.shade_meta()
+        kind: string, one of {'top', 'bottom'}
+
+    Returns: string, path to GeoTiff
+    """
+    return os.path.join(day_dir(day), f'{meta[kind]}.tif')
+
+
+def stored_days():
+    """
+    Return days in the shade store, see update_days()
+
+    Returns: dict, keys are days of the year, and values are lists of stored
+        frames for the day, each [hour, minute], complete days only
+    """
+    days = {}
+    for fn in glob.glob(os.path.join(cfg.SHADE_DIR, 'day_*', FRAMES_FILE)):
+        with open(fn, 'r') as fp:
+            record = json.load(fp)
+        days[record['day']] = record['frames']
+    return days
+
+
+def store_day(day=None):
+    """
+    Return the stored day used for a requested day
+
+    Sun geometry changes slowly from day to day, so frames are shared by all
+    days within cfg.SHADE_DAY_TOLERANCE of a stored day.
+
+    Arguments:
+        day: int, requested day of the year, default is today
+
+    Returns: int, nearest stored day, or None if none is within tolerance
+    """
+    day = day or _today()
+    days = [x for x in stored_days() if _day_dist(x, day) <= cfg.SHADE_DAY_TOLERANCE]
+    if not days:
+        return None
+    return min(days, key=lambda x: _day_dist(x, day))
+
+
+def daylight_frames(day):
+    """
+    Return frames for a day when the sun is above the horizon
+
+    Arguments:
+        day: int, day of the year
+
+    Returns: list of dicts, frame details, subset of common.shade_meta()
+    """
+    lat = sum(cfg.DOMAIN_YLIM_GEO)/2
+    return [meta for meta in common.shade_meta() 
+        if solar_position(day, meta['hour'] + meta['minute']/60, lat)[0] > 0]
+
+
+def update_days(first_day=None, num_days=1, nproc=1, engine=None, nthread=1):
+    """
+    Precompute insolation frames for a range of days in the shade store
+
+    Only frames with the sun above the horizon are computed, and days within
+    cfg.SHADE_DAY_TOLERANCE of a day already stored (or scheduled) reuse its
+    frames rather than being computed. Each day is marked complete only when
+    all its frames succeed.
+    
+    Arguments:
+        first_day: int, first day of the year to compute, default is today
+        num_days: int, number of days to cover
+        nproc: int, number of frames to compute concurrently
+        engine: string, one of 'native' to compute in-process, or 'grass' to
+            use GRASS r.sun, default is cfg.SHADE_ENGINE
+        nthread: int, number of threads for each frame, 'grass' engine only
+    
+    Raises: RuntimeError if any frame fails, after all frames are attempted 
+    """
+    engine = engine or cfg.SHADE_ENGINE
+    first_day = first_day or _today()
+
+    # select days to compute, reusing nearby days
+    covered = list(stored_days())
+    days = []
+    for num in range(num_days):
+        day = (first_day + num - 1) % DAYS_PER_YEAR + 1
+        if all(_day_dist(day, x) > cfg.SHADE_DAY_TOLERANCE for x in covered):
+            days.append(day)
+            covered.append(day)
+    logger.info(f'Computing shade for days {days}, the rest reuse stored days')
+
+    # create output directories, if needed
+    for day in days:
+        if not os.path.isdir(day_dir(day)):
+            os.makedirs(day_dir(day))
+
+    # recompute horizon angles if the surface was regridded since they were computed
+    if engine == 'native' and days and not horizon_current():
+        logger.warning('Horizon angles missing or stale, recomputing')
+        prep_native(nproc)
+
+    # create parallel executor, native workers load static inputs on first use, and
+    #   grass workers each start a session in a temporary mapset
+    if engine == 'native':
+        pool = concurrent.futures.ProcessPoolExecutor(nproc)
+        func, kwargs = insolation_native, {}
+    elif engine == 'grass':
+        pool = concurrent.futures.ThreadPoolExecutor(nproc)
+        func, kwargs = insolation, {'nthread': nthread}
+    else:
+        raise ValueError('Invalid choice for argument "engine"')
+    futures = {}
+    try:
+        for day in days:
+            for meta in daylight_frames(day): 
+                time = meta['hour'] + meta['minute']/60
+                top_name = frame_file(day, meta, 'top')
+                bot_name = frame_file(day, meta, 'bottom')
+                futures[pool.submit(func, day, time, top_name, bot_name, **kwargs)] = (day, meta)
+        pool.shutdown(wait=True)
+    finally:
+        _grass_cleanup()
+
+    # report failed frames, and mark complete days
+    failed = set()
+    for future, (day, meta) in futures.items():
+        try:
+            future.result()
+        except Exception as err:
+            logger.error(f'Failed to update frame {day:03d} {meta["hour"]:02d}:{meta["minute"]:02d}: {err}')
+            failed.add((day, meta['hour'], meta['minute']))
+    for day in days:
+        if not any(x[0] == day for x in failed):
+            frames = [[meta['hour'], meta['minute']] for meta in daylight_frames(day)]
+            with open(os.path.join(day_dir(day), FRAMES_FILE), 'w') as fp:
+                json.dump({'day': day, 'frames': frames}, fp)
+    if failed:
+        raise RuntimeError(f'Failed to update {len(failed)} of {len(futures)} insolation frames')
+
+
+def evict_days(first_day=None, num_days=1):
+    """
+    Delete stored days that are not used for any day in a range, see store_day()
+
+    Arguments:
+        first_day: int, first day of the year to keep, default is today
+        num_days: int, number of days to keep
+    """
+    first_day = first_day or _today()
+    keep = [(first_day + num - 1) % DAYS_PER_YEAR + 1 for num in range(num_days)]
+    for day in stored_days():
+        if all(_day_dist(day, x) > cfg.SHADE_DAY_TOLERANCE for x in keep):
+            logger.info(f'Evicting shade for day {day}')
+            shutil.rmtree(day_dir(day))
+
+
+def current_dir():
+    """Return stable path to the published day in the shade store, see publish_day()"""
+    return os.path.join(cfg.SHADE_DIR, CURRENT_DIR)
+
+
+def published_frames():
+    """
+    Return frames for the published day, see publish_day()
+
+    Returns: list of stored frames, each [hour, minute], empty if none is published
+    """
+    filename = os.path.join(current_dir(), FRAMES_FILE)
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, 'r') as fp:
+        return json.load(fp)['frames']
+
+
+def publish_day(day=None):
+    """
+    Point the current directory at the stored day used for a requested day
+
+    Geoserver layers read frames through this stable path, so they survive
+    when old days are evicted. The link is replaced atomically.
+
+    Arguments:
+        day: int, requested day of the year, default is today
+
+    Returns: int, published stored day, or None if none is within tolerance
+    """
+    day = store_day(day)
+    if day is None:
+        logger.warning('No shade stored for the requested day, nothing published')
+        return None
+    link = current_dir()
+    tmp_link = f'{link}.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.basename(day_dir(day)), tmp_link)
+    os.replace(tmp_link, link)
+    logger.info(f'Published shade for day {day}')
+    return day
+
+
+def update_today(nproc=1, engine=None, nthread=1):
+    """Update insolation frames for today, see update_days()"""
+    update_days(_today(), 1, nproc, engine, nthread)
+
+
+def _frame_weights(day, out_time, times, interp):
+    """
+    Return weights for blending stored frames to estimate insolation at a given time
+
+    Arguments:
+        day: int, day of the year
+        out_time: float, requested local solar time, decimal hours
+        times: list of floats, times of stored frames, decimal hours
+        interp: string, see retrieve()
+
+    Returns: dict, keys are frame times and values are weights
+    """
+    before = [x for x in times if x <= out_time]
+    after = [x for x in times if x >= out_time]
+    if interp == 'nearest' or not before or not after:
+        # snap to the nearest frame, which is also the only option outside the stored frames
+        weights = {min(times, key=lambda x: abs(x - out_time)): 1.0}
+    elif max(before) == min(after):
+        weights = {max(before): 1.0}
+    else:
+        t0, t1 = max(before), min(after)
+        ww = (out_time - t0)/(t1 - t0)
+        weights = {t0: 1 - ww, t1: ww}
+
+    # rescale each frame by the change in clear-sky intensity, roughly sin(sun elevation)
+    if interp == 'solar':
+        lat = sum(cfg.DOMAIN_YLIM_GEO)/2
+        sin_elev = lambda x: max(MIN_SIN_ELEVATION, math.sin(solar_position(day, x, lat)[0]))
+        weights = {tt: ww*sin_elev(out_time)/sin_elev(tt) for tt, ww in weights.items()}
+
+    return weights
+
+
+def retrieve(hour, minute, bbox=None, kind='top', day=None, interp='linear'):
+    """
+    Retrieve (subset of) insolation raster at the specified time
+
+    Arguments:
+        hour, min: floats, time to retrieve, if there is not an exact match,
+            the neighboring rasters are blended, see interp, and if the sun
+            is down, insolation is zero
         bbox: length-5 tuple/list, [x_min, x_max, y_min, y_max, srid], bounding
-            box used to clip raster, output may not match limits exactly 
+            box used to clip raster, output includes all pixels that intersect
+            the bounding box (reprojected to cfg.PRJ_SRID, if needed)
         kind: string, one of {'top', 'bottom'}, select upper or lower surface
             insolation raster
+        day: int, day of the year, default is today, read from the nearest
+            stored day, see store_day()
+        interp: string, one of 'nearest' to return the closest frame, 'linear'
+            to blend the frames before and after linearly in time, or 'solar'
+            to also scale each frame by the ratio of clear-sky intensity
+            (sine of the sun elevation) at the requested and frame times
     
     Returns: x_vec, y_vec, z_grd
-        x_vec, y_vec: numpy 1D arrays, coordinate vectors
-        z_grd: numpy 2D array, insolation
+        x_vec, y_vec: numpy 1D arrays, coordinate vectors, y is decreasing
+        z_grd: numpy 2D array, insolation, rows match y_vec and columns match x_vec
     """
     # check argument sanity
     if kind not in {'top', 'bottom'}: 
         raise ValueError('Invalid choice for argument "kind"')
+    if interp not in INTERP_METHODS: 
+        raise ValueError('Invalid choice for argument "interp"')
 
-    # handle bbox
+    # handle bbox, in the project coord sys
     if bbox:
-        raise NotImplementedError('Raster subsets are not yet supported')
+        x_min, x_max, y_min, y_max, srid = bbox
+        if srid != cfg.PRJ_SRID:
+            prj0 = osr.SpatialReference()
+            prj0.ImportFromEPSG(srid)
+            prj1 = osr.SpatialReference()
+            prj1.ImportFromEPSG(cfg.PRJ_SRID)
+            transform = osr.CoordinateTransformation(prj0, prj1)
+            corners = [transform.TransformPoint(x, y)[:2] for x, y in 
+                [(x_min, y_min), (x_max, y_min), (x_max, y_max), (x_min, y_max)]]
+            xx, yy = zip(*corners)
+            x_min, x_max, y_min, y_max = min(xx), max(xx), min(yy), max(yy)
 
-    # select insolation raster file
+    # select insolation raster file from the store
+    day = day or _today()
+    stored = store_day(day)
+    if stored is None:
+        raise FileNotFoundError(f'No shade stored within {cfg.SHADE_DAY_TOLERANCE} days of day {day}')
+    frames = stored_days()[stored]
+    metas = {meta['hour'] + meta['minute']/60: meta for meta in common.shade_meta() 
+        if [meta['hour'], meta['minute']] in frames}
     out_time = hour + minute/60
-    shade_time = 99999
-    for meta in common.shade_meta():
-        this_time = meta['hour'] + meta['minute']/60
-        if abs(out_time - this_time) < abs(out_time - shade_time):
-            shade_time = this_time
-            shade_file = os.path.join(cfg.SHADE_DIR, f'{meta[kind]}.tif')
+    weights = _frame_weights(day, out_time, sorted(metas), interp)
     
-    # read in raster (subset) and coordinate vectors
-    # TODO: implement subset using bounding box
-    ds = gdal.Open(shade_file)
-    z_grd = np.array(ds.GetRasterBand(1).ReadAsArray())
+    # read in raster (subset) and coordinate vectors, blending frames, all frames share one grid
+    z_grd = 0
+    for shade_time, weight in weights.items():
+        ds = gdal.Open(frame_file(stored, metas[shade_time], kind))
+        if not bbox:
+            x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+            x_min, x_max = x0, x0 + ds.RasterXSize*dx
+            y_min, y_max = y0 + ds.RasterYSize*dy, y0
+        window, x_vec, y_vec = surface.pixel_window(ds, x_min, x_max, y_min, y_max)
+        z_grd = z_grd + weight*ds.GetRasterBand(1).ReadAsArray(*window).astype(np.float32)
+    ds = None
 
-    transform = ds.GetGeoTransform()
-    y_pixel = np.arange(0, z_grd.shape[0])
-    x_pixel = np.arange(0, z_grd.shape[1])
-    x_vec = transform[0] + x_pixel*transform[1] + y_pixel*transform[2]
-    y_vec = transform[3] + x_pixel*transform[4] + y_pixel*transform[5]
+    # frames are only stored while the sun is up
+    if solar_position(day, out_time, sum(cfg.DOMAIN_YLIM_GEO)/2)[0] <= 0:
+        z_grd = np.zeros(z_grd.shape, dtype=z_grd.dtype)
 
     return x_vec, y_vec, z_grd
 
@@ -217,31 +992,52 @@ def initialize_cli():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter) 
     ap.add_argument('--log', type=str, default='info', help="select logging level",
                     choices=['debug', 'info', 'warning', 'error', 'critical'])
+    ap.add_argument('--engine', choices=ENGINES, default=None,
+        help='Insolation engine to prepare inputs for, default is SHADE_ENGINE in the configuration file')
+    ap.add_argument('--nproc', type=int, default=1,
+        help='Number of concurrent processes used to compute horizon angles (native engine only)')
     args = ap.parse_args()
 
     log_lvl = getattr(logging, args.log.upper())
     logging.basicConfig(level=log_lvl)
     logger.setLevel(log_lvl)
 
-    init_grass()
-    prep_inputs()
+    if (args.engine or cfg.SHADE_ENGINE) == 'grass':
+        init_grass()
+    prep_inputs(args.engine, args.nproc)
 
 
 def update_cli():
-    """Command line utility to init inputs for shade calculations"""
+    """Command line utility to update the shade store"""
     ap = argparse.ArgumentParser(
-        description="Update daily insolation rasters - clobbers existing!",
+        description="Precompute insolation rasters for upcoming days, and evict past days",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter) 
     ap.add_argument('--log', type=str, default='info', help="select logging level",
         choices=['debug', 'info', 'warning', 'error', 'critical'])
     ap.add_argument('--nproc', type=int, default=1,
         help='Number of concurrent processes to run')
+    ap.add_argument('--engine', choices=ENGINES, default=None,
+        help='Insolation engine, default is SHADE_ENGINE in the configuration file')
+    ap.add_argument('--nthread', type=int, default=1,
+        help='Number of threads for each frame, passed to r.sun (grass engine only)')
+    ap.add_argument('--start', type=int, default=None,
+        help='First day of the year to compute, default is today')
+    ap.add_argument('--days', type=int, default=cfg.SHADE_DAYS_AHEAD,
+        help='Number of days to compute, stored days not needed for these days are evicted')
     args = ap.parse_args()
 
     log_lvl = getattr(logging, args.log.upper())
     logging.basicConfig(level=log_lvl)
     logger.setLevel(log_lvl)
 
-    update_today(nproc=args.nproc)
+    update_days(args.start, args.days, nproc=args.nproc, engine=args.engine, nthread=args.nthread)
+
+    # publish before evicting, so geoserver never reads from a deleted day, and
+    #   register layers again if the published frames changed
+    old_frames = published_frames()
+    if publish_day(args.start) is not None and published_frames() != old_frames:
+        from parasol import geoserver
+        geoserver.add_geoserver_layers()
+    evict_days(args.start, args.days)
 
 
@@ -6,7 +6,9 @@ import logging
 import psycopg2 as pg
 import numpy as np
 import math
+import scipy
 from scipy.spatial import cKDTree
+from packaging.version import Version
 import gdal
 import osr
 import subprocess
@@ -15,7 +17,11 @@ import tempfile
 import argparse
 import os 
 from glob import glob
-import tempfile
+import concurrent.futures
+import json
+import hashlib
+import threading
+import queue
 
 import parasol
 from parasol import lidar, common, cfg
@@ -26,71 +32,305 @@ logger = logging.getLogger(__name__)
 # local constants
 PAD = 10 # meters
 TILE_DIM = 1000 # meters
-
-
-def grid_points(x_min, x_max, y_min, y_max):
+TILE_MAX_POINTS = 20000000 # desired maximum points per tile, before filtering
+TILE_MIN_DIM = 100 # meters, tiles are not split below this size
+KNN_NEIGHBORS = 16 # points per median, 'knn' engine
+KNN_CHUNK_NODES = 250000 # max grid nodes per tree query, 'knn' engine
+BIN_GRND_PERCENTILE = 0 # per-cell statistic for ground, 'bin' engine, 0 is min
+BIN_SURF_PERCENTILE = 100 # per-cell statistic for upper surface, 'bin' engine, 100 is max
+BIN_FILL_DIST = 5 # meters, max distance to fill empty cells, 'bin' engine
+ENGINES = ('knn', 'bin')
+# note: cKDTree.query renamed n_jobs to workers in scipy 1.6, Ubuntu 18.04 tops out at 1.5
+_KNN_WORKERS_KWARG = 'workers' if Version(scipy.__version__) >= Version('1.6') else 'n_jobs'
+GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'PREDICTOR=3']
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+PYRAMID_FACTORS = [2, 4, 8, 16] # decimation factors for pyramid levels, each a multiple of the last
+PYRAMID_STRIPE_ROWS = 4096 # rows read at once when building pyramid levels
+MANIFEST_FILE = 'tiles.json' # in cfg.SURFACE_DIR, records inputs and parameters for finished tiles
+BLOCK_CACHE_MB = 512 # GDAL (LRU) cache of decoded raster blocks, shared by all open datasets
+
+_datasets = {} # open raster datasets for retrieve(), keyed by file name
+_datasets_lock = threading.Lock()
+
+
+def surface_tiles(x_min, x_max, y_min, y_max, x_tile, y_tile, max_points=None):
     """
-    Grid scattered points using kNN median filter
+    Return list of tile bounding boxes for surface generation
 
     Arguments:
-        x_min, x_max, y_min, y_max: floats, limits for bounding box 
-        grnd: set True to compute surface from ground returns, False to compute
-            surface from (first) non-ground returns
+        x_min, x_max, y_min, y_max: floats, limits for the full region-of-interest
+        x_tile, y_tile: floats, desired (maximum) dimensions for generated
+            tiles, see common.tile_limits()
+        max_points: int, set to split tiles by point density, using the patch
+            summary from the LiDAR database, so that each tile has at most
+            this many points (before filtering), set None for uniform tiles
     
-    Returns: x_vec, y_vec, z_grd
-        x_vec, y_vec: numpy 1D arrays, x and y coordinate axes
-        z_surf, z_grnd: numpy 2D arrays, elevation grids 
+    Returns: list of bounding boxes, each a dict with fields x_min, x_max,
+        y_min, y_max, and num_points (balanced tiles only) 
+    """
+    if not max_points:
+        return common.tile_limits(x_min, x_max, y_min, y_max, x_tile, y_tile)
+    x_pts, y_pts, n_pts = lidar.patch_counts(x_min-PAD, x_max+PAD, y_min-PAD, y_max+PAD)
+    return common.tile_limits_balanced(x_min, x_max, y_min, y_max, x_tile, y_tile,
+        x_pts, y_pts, n_pts, max_points, TILE_MIN_DIM, cfg.SURFACE_RES_M)
+
+
+def fetch_points(x_min, x_max, y_min, y_max, version=None):
     """
+    Retrieve ground and upper surface points from the LiDAR database
 
+    Arguments:
+        x_min, x_max, y_min, y_max: floats, limits for bounding box, points
+            are retrieved in a pad around the bounding box too
+        version: string, LiDAR database version used as the point cache key,
+            see lidar.retrieve_cached()
+
+    Returns: grnd_pts, surf_pts, see grid_arrays()
+    """
     # Note from LiDAR metadata: ... Default (Class 1), Ground (Class 2), Noise
     # (Class 7), Water (Class 9), Ignored Ground (Class 10), Overlap Default
     # (Class 17) and Overlap Ground (Class 18).
 
+    # retrieve ground and upper surface points, including a pad on all sides
+    # note: filtered in the database, by default classified as "default",
+    #   "ground" or "water"
+    sets = lidar.retrieve_cached(x_min-PAD, x_max+PAD, y_min-PAD, y_max+PAD, {
+        'ground': (cfg.SURFACE_CLASSES, 'last'), # last or only return
+        'surface': (cfg.SURFACE_CLASSES, 'first'), # first or only return
+        }, version)
+    return sets['ground'], sets['surface']
+
+
+def grid_points(x_min, x_max, y_min, y_max, version=None, engine=None, workers=1):
+    """
+    Grid scattered points from the LiDAR database
+
+    Arguments:
+        x_min, x_max, y_min, y_max: floats, limits for bounding box 
+        version: string, LiDAR database version used as the point cache key,
+            see lidar.retrieve_cached()
+        engine: string, gridding engine, see grid_arrays()
+        workers: int, threads per tile, see grid_arrays()
+    
+    Returns: x_vec, y_vec, z_grnd, z_surf, see grid_arrays()
+    """
+    grnd_pts, surf_pts = fetch_points(x_min, x_max, y_min, y_max, version)
+    return grid_arrays(x_min, x_max, y_min, y_max, grnd_pts, surf_pts, engine, workers)
+
+
+def grid_arrays(x_min, x_max, y_min, y_max, grnd_pts, surf_pts, engine=None, workers=1):
+    """
+    Grid scattered ground and upper surface points
+
+    Arguments:
+        x_min, x_max, y_min, y_max: floats, limits for bounding box 
+        grnd_pts, surf_pts: numpy structured arrays with fields X, Y, Z, for
+            ground and upper surface points, should include points in a pad
+            around the bounding box
+        engine: string, one of 'knn' for the median of nearest neighbors at
+            each node, or 'bin' for a per-cell percentile of binned points,
+            default is cfg.SURFACE_ENGINE
+        workers: int, number of threads for nearest neighbor queries, -1 for
+            all cores, 'knn' engine only
+    
+    Returns: x_vec, y_vec, z_grnd, z_surf
+        x_vec, y_vec: numpy 1D arrays, x and y coordinate axes
+        z_grnd, z_surf: numpy 2D arrays, elevation grids 
+    """
+    engine = engine or cfg.SURFACE_ENGINE
+
     # build output grid spanning bbox
     x_vec = np.arange(math.floor(x_min), math.floor(x_max), cfg.SURFACE_RES_M)   
     y_vec = np.arange(math.floor(y_min), math.floor(y_max), cfg.SURFACE_RES_M)   
-    x_grd, y_grd = np.meshgrid(x_vec, y_vec)
-
-    # retrieve data, including a pad on all sides
-    pts = lidar.retrieve(x_min-PAD, x_max+PAD, y_min-PAD, y_max+PAD)
-
-    # extract ground points
-    grnd_idx = []
-    for idx, pt in enumerate(pts):
-        if pt[3] == pt[4] and pt[5] in {1, 2, 9}:
-            # last or only return, classified as "default", "ground" or "water"
-            grnd_idx.append(idx)
-    grnd_pts = pts[grnd_idx, :3]
-    
-    # extract upper surface points
-    surf_idx = []
-    for idx, pt in enumerate(pts):
-        if (pt[3] == 1 or pt[4] == 1) and pt[5] in {1, 2, 9}:
-            # first or only return, classified as "default", "ground", or "water" 
-            surf_idx.append(idx)
-    surf_pts = pts[surf_idx, :3]
-    del pts
 
-    z_grds = []
-    for pts in [grnd_pts, surf_pts]: 
-        # extract [x, y] and z arrays
-        xy = pts[:, :2]
-        zz = pts[:,  2]
+    if engine == 'knn':
+        z_grnd = _grid_knn(x_vec, y_vec, grnd_pts, workers)
+        z_surf = _grid_knn(x_vec, y_vec, surf_pts, workers)
+    elif engine == 'bin':
+        z_grnd = _grid_bin(x_vec, y_vec, grnd_pts, BIN_GRND_PERCENTILE)
+        z_surf = _grid_bin(x_vec, y_vec, surf_pts, BIN_SURF_PERCENTILE)
+    else:
+        raise ValueError('Invalid choice for argument "engine"')
 
-        # find NN for all grid points
-        tree = cKDTree(xy) 
-        xy_grd = np.hstack([x_grd.reshape((-1,1)), y_grd.reshape((-1,1))])
-        nn_dist, nn_idx = tree.query(xy_grd, k=16)
+    return x_vec, y_vec, z_grnd, z_surf
 
-        # compute local medians
-        z_grds.append(np.median(zz[nn_idx], axis=1).reshape(x_grd.shape))
 
-    return x_vec, y_vec, z_grds[0], z_grds[1]
+def _grid_knn(x_vec, y_vec, pts, workers=1):
+    """
+    Grid scattered points as the median of the nearest neighbors to each node
+
+    Nodes are queried in chunks of grid rows, so that working memory is
+    bounded by KNN_CHUNK_NODES rather than the grid size.
+
+    Arguments:
+        x_vec, y_vec: numpy 1D arrays, x and y coordinate axes
+        pts: numpy structured array with fields X, Y, Z
+        workers: int, number of threads for the tree query, -1 for all cores
+
+    Returns: numpy 2D array, elevation grid
+    """
+    nx, ny = len(x_vec), len(y_vec)
+    zz = pts['Z']
+    tree = cKDTree(np.column_stack((pts['X'], pts['Y']))) 
+
+    # median is the middle value (odd k) or the mean of the middle two (even k)
+    mid = [(KNN_NEIGHBORS - 1)//2, KNN_NEIGHBORS//2]
+
+    # buffers, reused for all chunks
+    rows = max(1, KNN_CHUNK_NODES//nx)
+    xy_buf = np.empty((rows*nx, 2))
+    xy_buf[:, 0] = np.tile(x_vec, rows)
+    z_buf = np.empty((rows*nx, KNN_NEIGHBORS), dtype=zz.dtype)
+    z_grd = np.empty((ny, nx), dtype=zz.dtype)
+
+    for row in range(0, ny, rows):
+        num = min(rows, ny - row)*nx
+        xy_buf[:num, 1] = np.repeat(y_vec[row:row+rows], nx)
+        
+        # find NN for grid nodes in chunk, discarding distances
+        _, nn_idx = tree.query(xy_buf[:num], k=KNN_NEIGHBORS, **{_KNN_WORKERS_KWARG: workers})
+        
+        # compute local medians by partial sort
+        z_nn = np.take(zz, nn_idx, out=z_buf[:num])
+        z_nn.partition(mid, axis=1)
+        z_grd[row:row+rows] = z_nn[:, mid].mean(axis=1).reshape((-1, nx))
+
+    return z_grd
+
+
+def _grid_bin(x_vec, y_vec, pts, percentile):
+    """
+    Grid scattered points as a percentile of the points binned in each cell
+
+    Each node is the center of a cell with width cfg.SURFACE_RES_M. Empty cells
+    are filled with the value of the nearest non-empty cell, up to
+    BIN_FILL_DIST, and any cells left over are NaN.
+
+    Arguments:
+        x_vec, y_vec: numpy 1D arrays, x and y coordinate axes
+        pts: numpy structured array with fields X, Y, Z
+        percentile: float, statistic to compute in each cell, in the range
+            [0, 100], 0 is the minimum and 100 is the maximum
+
+    Returns: numpy 2D array, elevation grid
+    """
+    nx, ny = len(x_vec), len(y_vec)
+    res = cfg.SURFACE_RES_M
+
+    # assign points to cells, dropping points outside the grid (i.e., in the pad)
+    ix = np.floor((pts['X'] - x_vec[0])/res + 0.5).astype(np.int64)
+    iy = np.floor((pts['Y'] - y_vec[0])/res + 0.5).astype(np.int64)
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    cell = iy[inside]*nx + ix[inside]
+    zz = pts['Z'][inside]
+
+    # sort by cell, then elevation, and pick the percentile rank in each cell
+    order = np.lexsort((zz, cell))
+    cell = cell[order]
+    zz = zz[order]
+    count = np.bincount(cell, minlength=nx*ny)
+    first = np.cumsum(count) - count
+    full = np.flatnonzero(count)
+    rank = np.rint((count[full] - 1)*percentile/100.0).astype(np.int64)
+    z_grd = np.full(nx*ny, np.nan, dtype=np.float32)
+    z_grd[full] = zz[first[full] + rank]
+
+    # fill empty cells from the nearest non-empty cell, within limits
+    empty = np.flatnonzero(count == 0)
+    if len(empty) and len(full):
+        tree = cKDTree(np.column_stack((full % nx, full // nx)))
+        dist, idx = tree.query(np.column_stack((empty % nx, empty // nx)), 
+            distance_upper_bound=BIN_FILL_DIST/res)
+        found = np.isfinite(dist)
+        z_grd[empty[found]] = z_grd[full[idx[found]]]
+        if not np.all(found):
+            logger.warning(f'Unable to fill {np.sum(~found)} empty cells')
+
+    return z_grd.reshape((ny, nx))
+
+
+def laz_overlaps(tiles, laz_files):
+    """
+    Find LAZ files that overlap each tile (plus pad), using file header bounds
+
+    Arguments:
+        tiles: list of dicts, tile bounding boxes from common.tile_limits()
+        laz_files: list of strings, paths to source files in LAZ format
+
+    Returns: laz_files, overlaps
+        laz_files: list of strings, all file paths, sorted in spatial order
+            (west to east, then south to north)
+        overlaps: dict, keys are tile indices and values are lists of file
+            paths, in the same order
+    """
+    bounds = {fn: lidar.laz_bounds(fn) for fn in laz_files}
+    laz_files = sorted(laz_files, key=lambda x: (bounds[x][0], bounds[x][2]))
+    overlaps = {}
+    for ii, tile in enumerate(tiles):
+        overlaps[ii] = []
+        for fn in laz_files:
+            xmin, xmax, ymin, ymax = bounds[fn]
+            if (xmin <= tile['x_max'] + PAD and xmax >= tile['x_min'] - PAD and
+                    ymin <= tile['y_max'] + PAD and ymax >= tile['y_min'] - PAD):
+                overlaps[ii].append(fn)
+    return laz_files, overlaps
+
+
+def route_laz(tiles, laz_files, overlaps):
+    """
+    Route points streamed directly from LAZ files to tiles, bypassing the database
+
+    Each file is read once. Points are routed to all tiles (plus pad) that
+    they fall in, and each tile is released as soon as the last file that
+    overlaps it (per the file header bounds) has been read, so only tiles
+    along the current "front" of files are held in memory. Files that overlap
+    none of the selected tiles are not read.
+
+    Arguments:
+        tiles: list of dicts, tile bounding boxes from common.tile_limits()
+        laz_files, overlaps: files in reading order, and files overlapping
+            each tile, from laz_overlaps(), only tiles included in overlaps
+            are routed
+
+    Yields: index, grnd_pts, surf_pts
+        index: int, position of the tile in the input list
+        grnd_pts, surf_pts: numpy structured arrays, ground and upper surface
+            points for the tile (plus pad), see grid_arrays()
+    """
+    # tiles wait for all overlapping files, which are read in spatial order to keep the front small
+    pending = {}
+    for ii, files in overlaps.items():
+        if files:
+            pending[ii] = set(files)
+        else:
+            logger.warning(f'No LAZ files overlap tile {ii}, skipping')
+    grnd_pts = {ii: [] for ii in pending}
+    surf_pts = {ii: [] for ii in pending}
+
+    for fn in laz_files:
+        active = [ii for ii in pending if fn in pending[ii]]
+        if not active:
+            continue
+        logger.info(f'Reading points from {fn}')
+        for pts in lidar.iter_laz(fn, cfg.SURFACE_CLASSES):
+            for ii in active:
+                tile = tiles[ii]
+                in_tile = ((pts['X'] >= tile['x_min'] - PAD) & (pts['X'] <= tile['x_max'] + PAD) &
+                    (pts['Y'] >= tile['y_min'] - PAD) & (pts['Y'] <= tile['y_max'] + PAD))
+                grnd_pts[ii].append(pts[in_tile & lidar.select(pts, returns='last')])
+                surf_pts[ii].append(pts[in_tile & lidar.select(pts, returns='first')])
+        
+        # release all tiles that have no more files to read
+        for ii in active:
+            pending[ii].remove(fn)
+            if not pending[ii]:
+                del pending[ii]
+                yield ii, np.concatenate(grnd_pts.pop(ii)), np.concatenate(surf_pts.pop(ii))
 
 
 def create_geotiff(filename, x_vec, y_vec, z_grd):
     """
-    Write input array as GeoTiff raster
+    Write input array as internally tiled, compressed GeoTiff raster
     
     Arguments:
         filename: string, path to write GeoTiff file
@@ -105,9 +345,11 @@ def create_geotiff(filename, x_vec, y_vec, z_grd):
     # create file
     rows, cols = z_grd.shape
     driver = gdal.GetDriverByName('GTiff')
-    outRaster = driver.Create(filename, cols, rows, 1, gdal.GDT_Float32)
+    outRaster = driver.Create(filename, cols, rows, 1, gdal.GDT_Float32, GTIFF_OPTIONS)
     outRaster.SetGeoTransform((x_vec[0], cfg.SURFACE_RES_M, 0, y_vec[0], 0, -cfg.SURFACE_RES_M))
     outband = outRaster.GetRasterBand(1)
+    if np.any(np.isnan(z_grd)):
+        outband.SetNoDataValue(np.nan)
     outband.WriteArray(z_grd)
     outRasterSRS = osr.SpatialReference()
     outRasterSRS.ImportFromEPSG(cfg.PRJ_SRID)
@@ -117,93 +359,398 @@ def create_geotiff(filename, x_vec, y_vec, z_grd):
     driver = outRaster = outband = None
 
 
-# TODO: make this concurrent
-def create_surfaces(x_min, x_max, y_min, y_max, x_tile, y_tile):
+def surface_file(which, res=None):
+    """
+    Return path to the mosaic or pyramid level for the selected surface
+
+    Arguments:
+        which: string, which raster to retrieve data from, must be one of
+            'surface', 'ground'
+        res: float, target resolution in meters, selects the coarsest level
+            with resolution no coarser than this, default is full resolution
+
+    Returns: string, path to the VRT mosaic over all tiles, or to a pyramid level
+    """
+    if which not in ('surface', 'ground'):
+        raise ValueError('Invalid choice for "which" variable')
+    factors = [x for x in PYRAMID_FACTORS if res and x*cfg.SURFACE_RES_M <= res]
+    if factors:
+        return os.path.join(cfg.SURFACE_DIR, f'{which}_{max(factors)}x.tif')
+    return os.path.join(cfg.SURFACE_DIR, f'{which}.vrt')
+
+
+def create_mosaic(which):
+    """
+    Build VRT mosaic with overviews over all tiles for the selected surface
+
+    Arguments:
+        which: string, one of 'surface', 'ground'
+
+    Returns: Nothing, writes VRT and external overviews (.ovr) to cfg.SURFACE_DIR
+    """
+    vrt_file = surface_file(which)
+    tile_files = sorted(glob(os.path.join(cfg.SURFACE_DIR, f'{which}_tile_*.tif')))
+    logger.info(f'Building mosaic {vrt_file} from {len(tile_files)} tiles')
+    ds = gdal.BuildVRT(vrt_file, tile_files)
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+    gdal.SetConfigOption('PREDICTOR_OVERVIEW', '3')
+    ds.BuildOverviews('AVERAGE', OVERVIEW_LEVELS)
+    ds = None
+
+
+def create_pyramid(which):
+    """
+    Build decimated pyramid levels for the selected surface from the full resolution mosaic
+
+    Cells are pooled with the maximum for the upper surface, so obstacles are
+    never lost, and the minimum for the ground. Each level is built from the
+    one before it, and written as a tiled, compressed GeoTiff.
+
+    Arguments:
+        which: string, one of 'surface', 'ground'
+
+    Returns: Nothing, writes one file per level to cfg.SURFACE_DIR, see surface_file()
+    """
+    pool = np.fmax if which == 'surface' else np.fmin
+    src_file = surface_file(which)
+    prev_factor = 1
+    for factor in PYRAMID_FACTORS:
+        dst_file = surface_file(which, factor*cfg.SURFACE_RES_M)
+        logger.info(f'Building pyramid level {dst_file}')
+        _decimate(src_file, dst_file, factor//prev_factor, pool)
+        src_file, prev_factor = dst_file, factor
+
+
+def _decimate(src_file, dst_file, ratio, pool):
+    """
+    Decimate a raster by pooling blocks of cells, one stripe of rows at a time
+
+    Arguments:
+        src_file, dst_file: strings, paths to input and output rasters
+        ratio: int, decimation factor, output cells pool ratio x ratio input cells
+        pool: numpy ufunc, NaN-ignoring pooling operation, e.g., np.fmax
+
+    Returns: Nothing, writes result to file
+    """
+    src = gdal.Open(src_file)
+    src_band = src.GetRasterBand(1)
+    nodata = src_band.GetNoDataValue()
+    x0, dx, _, y0, _, dy = src.GetGeoTransform()
+    cols, rows = src.RasterXSize, src.RasterYSize
+
+    driver = gdal.GetDriverByName('GTiff')
+    dst = driver.Create(dst_file, math.ceil(cols/ratio), math.ceil(rows/ratio), 1, gdal.GDT_Float32, 
+        GTIFF_OPTIONS)
+    dst.SetGeoTransform((x0, dx*ratio, 0, y0, 0, dy*ratio))
+    dst.SetProjection(src.GetProjection())
+    dst_band = dst.GetRasterBand(1)
+    dst_band.SetNoDataValue(np.nan)
+
+    stripe = max(1, PYRAMID_STRIPE_ROWS//ratio)*ratio
+    for row in range(0, rows, stripe):
+        z_grd = src_band.ReadAsArray(0, row, cols, min(stripe, rows - row)).astype(np.float32)
+        if nodata is not None:
+            z_grd[z_grd == nodata] = np.nan
+        # pad partial blocks at the edges, then pool blocks
+        z_grd = np.pad(z_grd, ((0, -z_grd.shape[0] % ratio), (0, -cols % ratio)), 
+            'constant', constant_values=np.nan)
+        z_grd = z_grd.reshape((z_grd.shape[0]//ratio, ratio, -1, ratio))
+        dst_band.WriteArray(pool.reduce(pool.reduce(z_grd, axis=3), axis=1), 0, row//ratio)
+
+    dst_band.FlushCache()
+    src = src_band = driver = dst = dst_band = None
+
+
+def write_tile(index, x_vec, y_vec, z_grnd, z_surf):
+    """
+    Write ground and surface grids for one tile as GeoTiff files in cfg.SURFACE_DIR
+
+    Arguments:
+        index: int, tile number, used in the file names
+        x_vec, y_vec, z_grnd, z_surf: output from grid_arrays()
+
+    Returns: Nothing
+    """
+    grnd_name, surf_name = _tile_files(index)
+    create_geotiff(grnd_name, x_vec, y_vec, z_grnd)
+    logger.info(f'Wrote tile {grnd_name}')
+    
+    create_geotiff(surf_name, x_vec, y_vec, z_surf)
+    logger.info(f'Wrote tile {surf_name}')
+
+
+def _db_tile(index, tile, version, engine, workers):
+    """Worker: grid one tile from the LiDAR database and write it"""
+    write_tile(index, *grid_points(tile['x_min'], tile['x_max'], tile['y_min'], tile['y_max'], 
+        version, engine, workers))
+
+
+def _grid_tile(index, tile, grnd_pts, surf_pts, engine, workers):
+    """Worker: grid one tile from points fetched or routed by the parent process and write it"""
+    write_tile(index, *grid_arrays(tile['x_min'], tile['x_max'], tile['y_min'], tile['y_max'],
+        grnd_pts, surf_pts, engine, workers))
+
+
+def _tile_files(index):
+    """Return paths to ground and surface files for one tile"""
+    return [os.path.join(cfg.SURFACE_DIR, f'{which}_tile_{index:04d}.tif') for which in ['ground', 'surface']]
+
+
+def read_manifest():
+    """
+    Read the manifest of finished tiles from cfg.SURFACE_DIR
+
+    Returns: dict, keys are tile indices and values are dicts with tile
+        bounds, and the input fingerprint and gridding parameters used to
+        generate the tile, empty if no manifest exists 
+    """
+    try:
+        with open(os.path.join(cfg.SURFACE_DIR, MANIFEST_FILE), 'r') as fp:
+            return {int(k): v for k, v in json.load(fp).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(manifest):
+    """Write the manifest of finished tiles, atomically replacing the old version"""
+    filename = os.path.join(cfg.SURFACE_DIR, MANIFEST_FILE)
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def prefetch(items, size):
+    """
+    Iterate over items produced in a background thread, up to size items ahead
+
+    Arguments:
+        items: iterable, e.g., a generator that does (I/O bound) work to
+            produce each item
+        size: int, maximum number of items waiting in the queue
+
+    Yields: items, in order, errors raised by the producer are re-raised here
+    """
+    buf = queue.Queue(size)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                buf.put(item)
+            buf.put(done)
+        except Exception as err:
+            buf.put(err)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buf.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _finish_tiles(running, manifest, records):
+    """
+    Wait for at least one running tile job, and record finished tiles in the manifest
+
+    Arguments:
+        running: dict, keys are futures and values are tile indices, finished
+            jobs are removed
+        manifest: dict, manifest of finished tiles, see read_manifest(),
+            updated and written for finished jobs
+        records: dict, manifest records for all tiles
+
+    Returns: Nothing
+    """
+    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in done:
+        index = running.pop(future)
+        future.result() # raise any errors
+        manifest[index] = records[index]
+        _write_manifest(manifest)
+        logger.info(f'Completed tile {len(manifest)} of {len(records)}')
+
+
+def create_surfaces(x_min, x_max, y_min, y_max, x_tile, y_tile, source='db', max_points=None, nproc=1,
+        engine=None, nthread=1, clean=False, prefetch_tiles=0):
     """
     Generate rasters and upload to database, tile-by-tile
 
+    Tiles are recorded in a manifest with their bounds, a fingerprint of the
+    input points, and the gridding parameters. Tiles that are finished and
+    unchanged are skipped, so an interrupted run resumes where it stopped,
+    and a change to some LiDAR files only regenerates the tiles they overlap. 
+
     Arguments:
         x_min, x_max, y_min, y_max: floats, limits for the full region-of-interest
         x_tile, y_tile: floats, desired dimensions for generated tiles, note that
             the actual dimensions are adjusted to evenly divide the ROI
+        source: string, one of 'db' to read points from the LiDAR database, or
+            'laz' to read points directly from the LAZ files in cfg.LIDAR_DIR
+        max_points: int, set to split tiles by point density, see surface_tiles()
+        nproc: int, number of tiles to grid concurrently, at most this many
+            tiles are in memory at once (plus one being routed, for 'laz')
+        engine: string, gridding engine, see grid_arrays()
+        nthread: int, number of threads used to grid each tile, see grid_arrays()
+        clean: bool, set True to discard existing tiles and regenerate all
+        prefetch_tiles: int, set to fetch (or route) points in a background
+            thread of the main process, up to this many tiles ahead of the
+            gridding workers, so that I/O overlaps compute, or 0 to fetch
+            points in the workers
     
     Returns: nothing
     """
-    tiles = common.tile_limits(x_min, x_max, y_min, y_max, x_tile, y_tile)
+    tiles = surface_tiles(x_min, x_max, y_min, y_max, x_tile, y_tile, max_points)
     num_tiles = len(tiles)
-
-    modes = ['add'] * len(tiles)
-    modes[0] = 'create'
-    modes[-1] = 'finish'
     
     # create directory, if needed
     if not os.path.isdir(cfg.SURFACE_DIR):
         os.makedirs(cfg.SURFACE_DIR)
 
-    # generate tiles
-    for ii, tile in enumerate(tiles):
-        logger.info(f'Generating tile {ii+1} of {num_tiles}')
-        x_vec, y_vec, z_grnd, z_surf = grid_points(**tile)
-        
-        logger.info(f'Gridding ground points')
-        grnd_name = os.path.join(cfg.SURFACE_DIR, 'ground_tile_{:04d}.tif'.format(ii))
-        create_geotiff(grnd_name, x_vec, y_vec, z_grnd)
-        logger.info(f'Wrote tile {grnd_name}')
-        
-        logger.info(f'Gridding surface points')
-        surf_name = os.path.join(cfg.SURFACE_DIR, 'surface_tile_{:04d}.tif'.format(ii))
-        create_geotiff(surf_name, x_vec, y_vec, z_surf)
-        logger.info(f'Wrote tile {surf_name}')
-
-    # merge tiles
-    logger.info('Merging tiles')
-    for prefix in ['ground', 'surface']:
-        cmd =  ['gdal_merge.py']
-        cmd.extend(glob(os.path.join(cfg.SURFACE_DIR, prefix + '_tile_*.tif')))
-        cmd.extend(['-of', 'GTiff', '-o', os.path.join(cfg.SURFACE_DIR, prefix + '.tif')])
-        subprocess.run(cmd)
-
-    # delete tiles, which are no longer needed
-    logger.info('Deleting tile files')
+    # fingerprint inputs for all tiles
+    if source == 'db':
+        inputs = [lidar.fingerprint(t['x_min']-PAD, t['x_max']+PAD, t['y_min']-PAD, t['y_max']+PAD) 
+            for t in tiles]
+    elif source == 'laz':
+        laz_files, overlaps = laz_overlaps(tiles, glob(os.path.join(cfg.LIDAR_DIR, '*.laz')))
+        stats = {fn: os.stat(fn) for fn in laz_files}
+        inputs = []
+        for ii in range(num_tiles):
+            files = [f'{os.path.basename(fn)}:{stats[fn].st_size}:{stats[fn].st_mtime_ns}' 
+                for fn in sorted(overlaps[ii])]
+            inputs.append(hashlib.sha1(','.join(files).encode('utf-8')).hexdigest())
+    else:
+        raise ValueError('Invalid choice for argument "source"')
+    params = {
+        'source': source, 
+        'engine': engine or cfg.SURFACE_ENGINE, 
+        'res': cfg.SURFACE_RES_M, 
+        'classes': sorted(cfg.SURFACE_CLASSES),
+        'pad': PAD,
+        'knn_neighbors': KNN_NEIGHBORS, 
+        'bin_percentiles': [BIN_GRND_PERCENTILE, BIN_SURF_PERCENTILE], 
+        'bin_fill_dist': BIN_FILL_DIST,
+        }
+    records = {ii: {**{k: tile[k] for k in ['x_min', 'x_max', 'y_min', 'y_max']}, 
+        'inputs': inputs[ii], 'params': params} for ii, tile in enumerate(tiles)}
+
+    # find tiles to generate, and delete tiles no longer in the domain
+    manifest = {} if clean else read_manifest()
     for fn in glob(os.path.join(cfg.SURFACE_DIR, '*_tile_*.tif')):
-        os.remove(fn)
+        index = int(os.path.splitext(fn)[0].rsplit('_', 1)[1])
+        if index >= num_tiles or clean:
+            os.remove(fn)
+            manifest.pop(index, None)
+    todo = [ii for ii in range(num_tiles) if manifest.get(ii) != records[ii] or 
+        not all(os.path.isfile(fn) for fn in _tile_files(ii))]
+    for ii in todo:
+        manifest.pop(ii, None)
+        for fn in _tile_files(ii):
+            if os.path.isfile(fn):
+                os.remove(fn)
+    _write_manifest(manifest)
+    logger.info(f'Generating {len(todo)} of {num_tiles} tiles, the rest are unchanged')
+
+    # list of tile jobs, generated lazily so that points are only held for running (and prefetched) jobs
+    version = lidar.db_version() if source == 'db' and cfg.LIDAR_CACHE_MB else None
+    if source == 'db' and not prefetch_tiles:
+        jobs = ((ii, (_db_tile, ii, tiles[ii], version, engine, nthread)) for ii in todo)
+    else:
+        if source == 'db':
+            points = ((ii, *fetch_points(tiles[ii]['x_min'], tiles[ii]['x_max'], tiles[ii]['y_min'], 
+                tiles[ii]['y_max'], version)) for ii in todo)
+        else:
+            points = route_laz(tiles, laz_files, {ii: overlaps[ii] for ii in todo})
+        if prefetch_tiles:
+            points = prefetch(points, prefetch_tiles)
+        jobs = ((ii, (_grid_tile, ii, tiles[ii], grnd, surf, engine, nthread)) for ii, grnd, surf in points)
+
+    # generate tiles, keeping at most nproc jobs in flight, and record each when finished
+    with concurrent.futures.ProcessPoolExecutor(nproc) as pool:
+        running = {}
+        for ii, job in jobs:
+            while len(running) >= nproc:
+                _finish_tiles(running, manifest, records)
+            running[pool.submit(*job)] = ii
+        while running:
+            _finish_tiles(running, manifest, records)
+
+    # mosaic tiles, tile files are kept as the mosaic data, and build pyramid levels
+    outputs = [surface_file(x, f*cfg.SURFACE_RES_M) for x in ['ground', 'surface'] for f in [1] + PYRAMID_FACTORS]
+    if todo or not all(os.path.isfile(fn) for fn in outputs):
+        for which in ['ground', 'surface']:
+            create_mosaic(which)
+            create_pyramid(which)
+
+
+def _open_dataset(filename):
+    """
+    Return a raster dataset handle, kept open for reuse, and reopened if the file changed
+
+    Arguments:
+        filename: string, path to raster file
+
+    Returns: gdal.Dataset
+    """
+    mtime = os.stat(filename).st_mtime_ns
+    if filename not in _datasets or _datasets[filename][0] != mtime:
+        if not _datasets:
+            gdal.SetCacheMax(BLOCK_CACHE_MB*1024*1024)
+        _datasets[filename] = (mtime, gdal.Open(filename))
+    return _datasets[filename][1]
 
 
-def retrieve(x_min, x_max, y_min, y_max, which):
+def pixel_window(ds, x_min, x_max, y_min, y_max):
+    """
+    Find the pixel window covering a bounding box in a north-up raster
+
+    Arguments:
+        ds: gdal.Dataset, raster to read from
+        x_min, x_max, y_min, y_max: floats, bounding box in the raster coord sys
+
+    Returns: window, x_vec, y_vec
+        window: tuple, (col, row, num_cols, num_rows), clipped to the raster
+            limits, suitable for ReadAsArray()
+        x_vec, y_vec: numpy 1D arrays, coordinate vectors for the window, y
+            is decreasing
+    """
+    x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+    col_min = max(0, math.floor((x_min - x0)/dx))
+    col_max = min(ds.RasterXSize, math.ceil((x_max - x0)/dx))
+    row_min = max(0, math.floor((y_max - y0)/dy))
+    row_max = min(ds.RasterYSize, math.ceil((y_min - y0)/dy))
+    if col_max <= col_min or row_max <= row_min:
+        raise ValueError('Bounding box does not intersect the raster')
+    window = (col_min, row_min, col_max - col_min, row_max - row_min)
+    return window, x0 + np.arange(col_min, col_max)*dx, y0 + np.arange(row_min, row_max)*dy
+
+
+def retrieve(x_min, x_max, y_min, y_max, which, res=None):
     """
     Retrieve subset within specified ROI
+
+    Reads a window from a dataset handle that is kept open between calls, so
+    that decoded blocks are reused from the GDAL block cache.
     
     Arguments:
         minx, maxx, miny, maxy: floats, limits for bounding box 
         which: string, which raster to retrieve data from, must be one of
             'surface', 'ground'
+        res: float, target resolution in meters, reads from the coarsest
+            pyramid level that is no coarser than this, see surface_file()
 
-    Returns: x_grd, y_grd, z_grd
+    Returns: x_vec, y_vec, z_grd
+        x_vec, y_vec: numpy 1D arrays, coordinate vectors, y is decreasing
+        z_grd: numpy 2D array, elevation grid, all pixels that intersect the ROI
     """
-    # get raster file name
-    if which == 'surface':
-        src_file = os.path.join(cfg.SURFACE_DIR, 'surface.tif')
-    elif which == 'ground':
-        src_file = os.path.join(cfg.SURFACE_DIR, 'ground.tif')
-    else:
-        raise ValueError('Invalid choice for "which" variable')
-
-    # get subset as file
-    with tempfile.NamedTemporaryFile() as fp:
-        dest_file = fp.name
-        subprocess.run(['gdal_translate', '-of', 'GTiff', '-projwin',
-            str(x_min), str(y_max), str(x_max), str(y_min), src_file, dest_file])
-
-        ds = gdal.Open(dest_file)
-        z_grd = np.array(ds.GetRasterBand(1).ReadAsArray())
-
-        transform = ds.GetGeoTransform()
-        y_pixel = np.arange(0, z_grd.shape[0]).reshape((z_grd.shape[0], 1))
-        x_pixel = np.arange(0, z_grd.shape[1]).reshape((1, z_grd.shape[1]))
-        x_grd = transform[0] + x_pixel*transform[1] + y_pixel*transform[2]
-        y_grd = transform[3] + x_pixel*transform[4] + y_pixel*transform[5]
-
-    return x_grd, y_grd, z_grd
+    with _datasets_lock:
+        ds = _open_dataset(surface_file(which, res))
+        window, x_vec, y_vec = pixel_window(ds, x_min, x_max, y_min, y_max)
+        z_grd = ds.GetRasterBand(1).ReadAsArray(*window)
+    
+    return x_vec, y_vec, z_grd
 
 
 # command line utilities -----------------------------------------------------
@@ -217,18 +764,39 @@ def initialize_cli():
     ap.add_argument('--log', type=str, default='info', help="select logging level",
                     choices=['debug', 'info', 'warning', 'error', 'critical'])
     ap.add_argument('--dryrun', action='store_true', help='Set to preview only')
+    ap.add_argument('--source', type=str, default='db', choices=['db', 'laz'],
+        help='Read points from the LiDAR database or directly from LAZ files')
+    ap.add_argument('--max-points', type=int, default=TILE_MAX_POINTS,
+        help='Split tiles to bound points per tile using the LiDAR database, 0 for uniform tiles')
+    ap.add_argument('--nproc', type=int, default=1,
+        help='Number of tiles to generate concurrently')
+    ap.add_argument('--engine', choices=ENGINES, default=None,
+        help='Gridding engine, default is SURFACE_ENGINE in the configuration file')
+    ap.add_argument('--nthread', type=int, default=1,
+        help='Number of threads used to grid each tile, -1 for all cores')
+    ap.add_argument('--clean', action='store_true', 
+        help='Regenerate all tiles, rather than only new or changed tiles')
+    ap.add_argument('--prefetch', type=int, default=0,
+        help='Number of tiles to fetch points for ahead of gridding, 0 to fetch in the gridding workers')
     args = ap.parse_args()
 
     log_lvl = getattr(logging, args.log.upper())
     logging.basicConfig(level=log_lvl)
     logger.setLevel(log_lvl)
 
+    # balanced tiles require the point summary from the database
+    max_points = args.max_points if args.source == 'db' else None
+
     if (args.dryrun):
-        tiles = common.tile_limits(cfg.DOMAIN_XLIM[0], cfg.DOMAIN_XLIM[1],
-            cfg.DOMAIN_YLIM[0], cfg.DOMAIN_YLIM[1], TILE_DIM, TILE_DIM)
+        tiles = surface_tiles(cfg.DOMAIN_XLIM[0], cfg.DOMAIN_XLIM[1],
+            cfg.DOMAIN_YLIM[0], cfg.DOMAIN_YLIM[1], TILE_DIM, TILE_DIM, max_points)
         print(f'Compute raster in domain: [[{cfg.DOMAIN_XLIM}], [{cfg.DOMAIN_YLIM}]]')
         print(f'Num tiles: {len(tiles)}')
+        if max_points:
+            num_points = [x['num_points'] for x in tiles]
+            print(f'Points per tile: min {min(num_points)}, max {max(num_points)}, total {sum(num_points)}')
     
     else:
         create_surfaces(cfg.DOMAIN_XLIM[0], cfg.DOMAIN_XLIM[1], cfg.DOMAIN_YLIM[0],
-           cfg. DOMAIN_YLIM[1], TILE_DIM, TILE_DIM)
+           cfg. DOMAIN_YLIM[1], TILE_DIM, TILE_DIM, args.source, max_points, args.nproc,
+           args.engine, args.nthread, args.clean, args.prefetch)